@@ -1,156 +1,400 @@
+import argparse
 import asyncio
 import shutil
 from datetime import datetime, timedelta
-from typing import List, cast
+from typing import List
 
 from discord import Embed
-import filetype
 
-from modules import bluesky, tumblr, twitter
-from sources import CatAPI, DogAPI, ImageSource
+from modules import (
+    bluesky,
+    check_bluesky,
+    check_tumblr,
+    check_twitter,
+    prepare_bluesky,
+    prepare_twitter,
+    tumblr,
+    twitter,
+    warm_bluesky,
+    warm_twitter,
+)
+from sources import CatAPI, DogAPI, ImageSource, LocalLibrary
+from utils.admin import AdminServer, pipeline
+from utils.alerts import alert, flush_alerts, resolve
+from utils.clock import VirtualClock, VirtualTimeLoop, get_clock, set_clock
 from utils.config import cfg
-from utils.constants import IMG_EXTENSIONS, MAX_IMG_FETCH_RETRY, MAX_IMG_SIZE_MB
+from utils.constants import ENCODER_PROFILE, FETCH_DEADLINE_SECONDS, MAX_IMG_FETCH_RETRY, MAX_IMG_SIZE_MB, PREP_LEAD_SECONDS, WARMUP_LEAD_SECONDS
+from utils.history import history
+from utils.http import close_session, warm_hosts
 from utils.image import SourceImage
+from utils.job import PostJob
 from utils.logger import Logger
+from utils.memory import MemoryWatchdog
+from utils.profiler import RunProfiler
+from utils.simulation import Simulation
+from utils.watchdog import LoopMonitor
 from utils.webhook import send_to_webhook
 
 log = Logger("Main")
 
-async def post():
-    post_log = Logger("Post")
+def create_sources() -> List[ImageSource]:
+    sources: List[ImageSource] = []
 
-    img_data = None
-    img_url = None
-    sources: List[ImageSource] = [
-        CatAPI(cfg),
-        DogAPI(cfg),
-    ]
+    for source in [CatAPI(cfg), DogAPI(cfg)]:
+        library_cfg = cfg.cfg[source.cfg_key]['library']
+        if library_cfg['path']:
+            library = LocalLibrary(cfg, source.cfg_key, library_cfg['path'])
+            if library_cfg['mode'] == 'primary':
+                source = library
+            else:
+                source.fallback = library
 
-    for source in sources:
-        source_cfg = cfg.cfg[source.cfg_key]
+        sources.append(source)
 
-        # ensure at least one site is enabled otherwise we're wasting our time
-        if not source_cfg['enabled']:
-            post_log.info(f'Skipping disabled source "{source.cfg_key}" ("{source.name}").')
+    return sources
+
+
+async def prepare_image(source: ImageSource, post_time: datetime, deadline: datetime) -> tuple[SourceImage, str] | None:
+    prep_log = Logger("Prepare")
+    source_cfg = cfg.cfg[source.cfg_key]
+
+    # fetch & validate img from the best endpoint, hedging slow attempts until the fetch deadline
+    img_data, img_url = await source.fetch_img_routed(deadline)
+
+    if img_data is None or img_url is None:
+        prep_log.error(f'Failed to fetch image from "{source.cfg_key}" ("{source.name}"). Reached retry limit ({MAX_IMG_FETCH_RETRY}) or fetch deadline.')
+        await alert(
+            source_cfg["webhooks"]["misc"],
+            source.name,
+            source_cfg,
+            f'Failed to fetch image from "{source.cfg_key}" ("{source.name}"). Reached retry limit ({MAX_IMG_FETCH_RETRY}) or fetch deadline.'
+        )
+        return None
+
+    await resolve(source.name, source_cfg)
+
+    rendition = source.get_rendition(img_url, ENCODER_PROFILE, MAX_IMG_SIZE_MB)
+    # decoding & encoding is cpu bound, so keep it off the event loop
+    start = get_clock().time()
+    try:
+        img = await asyncio.to_thread(SourceImage, img_data, MAX_IMG_SIZE_MB, rendition=rendition)
+    except Exception as e:
+        history.record(source.cfg_key, post_time, source.name, 'process', start, False, size=len(img_data))
+        prep_log.error(f'Failed to process image from "{source.cfg_key}" ("{source.name}"): {e!r}')
+        await alert(
+            source_cfg["webhooks"]["misc"],
+            source.name,
+            source_cfg,
+            f'Failed to process image from "{source.cfg_key}" ("{source.name}").',
+            exception=e
+        )
+        return None
+
+    history.record(source.cfg_key, post_time, source.name, 'process', start, True, size=len(img.read()))
+    return img, img_url
+
+
+async def prepare_job(source: ImageSource, post_time: datetime) -> PostJob | None:
+    prep_log = Logger("Prepare")
+    deadline = post_time + timedelta(seconds=FETCH_DEADLINE_SECONDS)
+    source_cfg = cfg.cfg[source.cfg_key]
+
+    # ensure at least one site is enabled otherwise we're wasting our time
+    if not source_cfg['enabled']:
+        prep_log.info(f'Skipping disabled source "{source.cfg_key}" ("{source.name}").')
+        return None
+
+    if (
+        not source_cfg['twitter']['enabled'] and
+        not source_cfg['tumblr']['enabled'] and
+        not source_cfg['bluesky']['enabled']
+    ):
+        prep_log.error(f'No sites are enabled for the source "{source.cfg_key}" ("{source.name}"). Please enable at least one site in config.json.')
+        return None
+
+    # fetch enough images for the biggest album out of the enabled platforms
+    album_size = max(
+        source_cfg[platform]['album_size']
+        for platform in ('twitter', 'tumblr', 'bluesky')
+        if source_cfg[platform]['enabled']
+    )
+    start = get_clock().time()
+    attempts = source.total_attempts()
+    results = await asyncio.gather(*(prepare_image(source, post_time, deadline) for _ in range(album_size)))
+
+    # the same image can come back twice, so only keep one copy of each
+    images: List[SourceImage] = []
+    img_urls: List[str] = []
+    for result in results:
+        if result is None:
             continue
 
-        if (
-            not source_cfg['twitter']['enabled'] and
-            not source_cfg['tumblr']['enabled'] and
-            not source_cfg['bluesky']['enabled']
-        ):
-            post_log.error(f'No sites are enabled for the source "{source.cfg_key}" ("{source.name}"). Please enable at least one site in config.json.')
+        img, img_url = result
+        if any(existing.hash == img.hash for existing in images):
+            img.cleanup()
             continue
 
-        # fetch & validate img
-        img_fetch_retry = 0
-        while img_fetch_retry < MAX_IMG_FETCH_RETRY:
-            img_data, img_url = source.fetch_img()
+        images.append(img)
+        img_urls.append(img_url)
 
-            # if no img data, retry
-            if not img_data or len(img_data) == 0:
-                img_fetch_retry += 1
-                post_log.error(f'Failed to fetch image from "{source.cfg_key}" ("{source.name}"). Retrying ({img_fetch_retry}/{MAX_IMG_FETCH_RETRY})')
-                continue
+    # every image needs at least one attempt, anything past that was a hedge or retry
+    history.record(
+        source.cfg_key,
+        post_time,
+        source.name,
+        'prepare',
+        start,
+        len(images) > 0,
+        retries=max(source.total_attempts() - attempts - album_size, 0),
+        size=sum(len(img.read()) for img in images)
+    )
 
-            # if img data is invalid, retry
-            img_type = filetype.guess(img_data)
-            if img_type is None or img_type.extension not in IMG_EXTENSIONS:
-                img_fetch_retry += 1
-                post_log.error(f'Source "{source.cfg_key}" ("{source.name}") returned an invalid image. Retrying ({img_fetch_retry}/{MAX_IMG_FETCH_RETRY})')
-                continue
+    if len(images) == 0:
+        return None
 
-            break
+    if len(images) < album_size:
+        prep_log.warning(f'Only got {len(images)}/{album_size} images for "{source.cfg_key}" ("{source.name}").')
 
+    job = PostJob(source_cfg, images, img_urls, post_time)
+
+    # upload media ahead of time where the platform allows it
+    await asyncio.gather(
+        asyncio.create_task(prepare_twitter(job), name=f'twitter:{source.cfg_key}'),
+        asyncio.create_task(prepare_bluesky(job), name=f'bluesky:{source.cfg_key}'),
+    )
+
+    return job
+
+
+async def prepare(sources: List[ImageSource], post_time: datetime) -> List[PostJob]:
+    jobs = await asyncio.gather(*(
+        asyncio.create_task(prepare_job(source, post_time), name=f'prepare:{source.cfg_key}')
+        for source in sources
+    ))
+    return [job for job in jobs if job is not None]
 
-        if img_fetch_retry == MAX_IMG_FETCH_RETRY:
-            post_log.error(f'Failed to fetch image from "{source.cfg_key}" ("{source.name}"). Reached retry limit ({MAX_IMG_FETCH_RETRY}).')
-            embed = Embed(
-                title='Error',
-                description=f'Failed to fetch image from "{source.cfg_key}" ("{source.name}"). Reached retry limit ({MAX_IMG_FETCH_RETRY}).',
-            )
-            await send_to_webhook(
-                url=source_cfg["webhooks"]["misc"],
-                content='@everyone',
-                embed=embed
-            )
-            continue
 
-        # resize the image to be below 1 mb if applicable
-        if img_data is None:
-            post_log.error('Failed to fetch image data: img_data is None after fetching')
-            embed = Embed(
-                title='Error',
-                description=f'Failed to fetch image data: `img_data` is `None` after fetching.',
-            )
-            await send_to_webhook(
-                url=source_cfg["webhooks"]["misc"],
-                content='@everyone',
-                embed=embed
-            )
+# hosts that are only requested at posting time, so their pooled connections have usually gone idle by then
+# (media is uploaded while preparing, so the upload host doesn't need it)
+WARM_HOSTS = ['https://api.tumblr.com/', 'https://discord.com/']
+
+async def warm_up(jobs: List[PostJob]):
+    tasks = [warm_hosts(WARM_HOSTS)]
+    for job in jobs:
+        tasks.append(warm_twitter(job))
+        tasks.append(warm_bluesky(job.source_cfg))
+
+    await asyncio.gather(*tasks)
+
+
+# makes sure every enabled account can log in before waiting for the first run
+async def check_credentials() -> bool:
+    checks = []
+    for key in ('cat', 'dog'):
+        source_cfg = cfg.cfg[key]
+        if not source_cfg['enabled']:
             continue
 
+        if source_cfg['twitter']['enabled']:
+            checks.append(check_twitter(source_cfg))
+
+        if source_cfg['tumblr']['enabled']:
+            checks.append(check_tumblr(source_cfg))
+
+        if source_cfg['bluesky']['enabled']:
+            checks.append(check_bluesky(source_cfg))
 
-        img = SourceImage(cast(bytes, img_data))
-        if img.get_size_mb() > MAX_IMG_SIZE_MB:
-            while img.get_size_mb() > MAX_IMG_SIZE_MB:
-                dimensions = img.get_dimensions()
-                width = int(dimensions[0] * 0.9)
-                height = int(dimensions[1] * 0.9)
-                img.resize(width, height, 90)
+    # None means the platform couldn't be reached, which shouldn't stop us from starting,
+    # & a check that blew up is treated the same way
+    results = await asyncio.gather(*checks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            log.warning(f'Could not check credentials: {result!r}')
 
-        # if everything is successful, post the image to all the platforms
-        twitter_url = await twitter(source_cfg, img, img_url)
-        tumblr_url = await tumblr(source_cfg, img, img_url)
-        bluesky_url = await bluesky(source_cfg, img, img_url)
+    return all(result is not False for result in results)
 
-        webhook_url = source_cfg['webhooks']['post_notification']
-        if webhook_url and (twitter_url or tumblr_url or bluesky_url):
-          embed = Embed(title='Photo')
 
-          # add post urls
-          post_urls = ''
-          if twitter_url is not None:
-            post_urls += f'- [Twitter]({twitter_url})\n'
+async def post_job(job: PostJob):
+    source_cfg = job.source_cfg
+    img_url = job.img_urls[0]
 
-          if tumblr_url is not None:
-            post_urls += f'- [Tumblr]({tumblr_url})\n'
+    # if everything is successful, post the image to all the platforms
+    key = source_cfg['key']
+    twitter_url = await asyncio.create_task(twitter(job), name=f'twitter:{key}')
+    tumblr_url = await asyncio.create_task(tumblr(job), name=f'tumblr:{key}')
+    bluesky_url = await asyncio.create_task(bluesky(job), name=f'bluesky:{key}')
 
-          if bluesky_url is not None:
-            post_urls += f'- [Bluesky]({bluesky_url})\n'
+    webhook_url = source_cfg['webhooks']['post_notification']
+    if webhook_url and (twitter_url or tumblr_url or bluesky_url):
+      embed = Embed(title='Photo')
 
-          if post_urls:
-            embed.add_field(name='URLs', value=post_urls, inline=False)
+      # add post urls
+      post_urls = ''
+      if twitter_url is not None:
+        post_urls += f'- [Twitter]({twitter_url})\n'
 
-          embed.set_image(url=img_url)
-          await send_to_webhook(
-            url=webhook_url,
-            embed=embed
-          )
+      if tumblr_url is not None:
+        post_urls += f'- [Tumblr]({tumblr_url})\n'
 
-        img.cleanup()
+      if bluesky_url is not None:
+        post_urls += f'- [Bluesky]({bluesky_url})\n'
 
+      if post_urls:
+        embed.add_field(name='URLs', value=post_urls, inline=False)
+
+      # local library images don't have a public url
+      if img_url.startswith('http'):
+        embed.set_image(url=img_url)
+      await send_to_webhook(
+        url=webhook_url,
+        embed=embed
+      )
+
+
+async def post(jobs: List[PostJob]):
+    for job in jobs:
+        try:
+            await post_job(job)
+        finally:
+            job.close()
+
+    # roll up any repeated errors from this run
+    await flush_alerts()
     print()
 
 
-async def main():
-    shutil.rmtree('jobs', ignore_errors=True)
-    cfg.validate(should_exit=True)
+# posts every hour (or straight away when a run is triggered) until drained or the simulation ends
+async def schedule(sources: List[ImageSource], profiler: RunProfiler, simulation: Simulation | None = None):
+    clock = get_clock()
 
-    while True:
-    # run loop 15s early to account for img fetching
-        current_time = datetime.now()
-        goal_timestamp = current_time + timedelta(hours = 1, minutes = -current_time.minute, seconds = -current_time.second, microseconds=-current_time.microsecond)
+    while not pipeline.draining and (simulation is None or simulation.running()):
+        # the next hour is worked out on the current utc offset, so it's always one real hour after the last,
+        # then localized again so the hour repeated (or skipped) by a dst change still gets its post
+        current_time = clock.now()
+        goal_timestamp = (current_time.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)).astimezone()
 
+        pipeline.phase = 'waiting'
+        pipeline.next_run = goal_timestamp
         log.info(f'Posting at: {goal_timestamp.strftime("%H:%M:%S")}')
-        await asyncio.sleep((goal_timestamp - current_time).total_seconds())
 
-        await post()
+        # fetch & upload images ahead of time, or right away if a run was triggered
+        triggered = await pipeline.sleep_until(goal_timestamp - timedelta(seconds=PREP_LEAD_SECONDS))
+        if pipeline.draining:
+            break
+
+        if triggered:
+            goal_timestamp = clock.now()
+            pipeline.next_run = goal_timestamp
+            log.info('Run triggered, posting now.')
+
+        pipeline.start_run()
+        started_at = clock.time()
+        profiler.start()
+        try:
+            jobs = await prepare(sources, goal_timestamp)
+            pipeline.jobs = jobs
+
+            pipeline.phase = 'prepared'
+            profiler.pause()
+
+            # refresh connections & sessions shortly before posting, so the posts don't wait on handshakes
+            if not triggered:
+                await clock.sleep_until(goal_timestamp - timedelta(seconds=WARMUP_LEAD_SECONDS))
+                await warm_up(jobs)
+
+            await clock.sleep_until(goal_timestamp)
+            profiler.resume()
+
+            pipeline.phase = 'posting'
+            posted_at = clock.time()
+            await post(jobs)
+
+            pipeline.add_run(goal_timestamp, triggered, len(jobs), started_at, posted_at, clock.time())
+        finally:
+            pipeline.jobs = []
+            profiler.stop()
+            # written here so a run that failed while preparing (or was cut short) is still recorded
+            await history.flush()
+
+
+async def main(profile_every: int = 0, trace_memory: bool = False, simulation: Simulation | None = None):
+    shutil.rmtree('jobs', ignore_errors=True)
+    admin: AdminServer | None = None
+
+    if simulation is not None:
+        await simulation.start(cfg)
+    else:
+        cfg.validate(should_exit=True)
+
+    if not await check_credentials():
+        log.error('Some credentials were rejected, please check config.json.')
+        exit(1)
+
+    # sources are kept between runs so they remember how each endpoint has been performing
+    sources = create_sources()
+
+    if simulation is None:
+        monitor = LoopMonitor()
+        monitor.start()
+
+        memory_watchdog = MemoryWatchdog(trace_memory)
+        memory_watchdog.start()
+
+        if cfg.cfg['admin']['enabled']:
+            admin = AdminServer(monitor, sources)
+            await admin.start()
+
+    try:
+        await schedule(sources, RunProfiler(profile_every), simulation)
+    finally:
+        pipeline.phase = 'stopped'
+        if admin is not None:
+            await admin.stop()
+
+        if simulation is not None:
+            await simulation.stop()
+
+    log.info('Drained, exiting.' if pipeline.draining else 'Finished.')
+
+
+async def run(profile_every: int = 0, trace_memory: bool = False, simulation: Simulation | None = None):
+    task = asyncio.current_task()
+    if task is not None:
+        task.set_name('main')
+
+    try:
+        await main(profile_every, trace_memory, simulation)
+    finally:
+        await close_session()
+
+
+# runs the posting loop against stand-in apis on a virtual clock, so hours of posting take seconds
+def simulate(hours: int, start: datetime, seed: int):
+    clock = VirtualClock(start)
+    set_clock(clock)
+
+    simulation = Simulation(clock, hours, seed)
+    with asyncio.Runner(loop_factory=lambda: VirtualTimeLoop(clock)) as runner:
+        runner.run(run(simulation=simulation))
+
+    simulation.report(start)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Posts animal photos hourly.')
+    parser.add_argument('--profile', action='store_true', help='profile every run, writing a speedscope file per run')
+    parser.add_argument('--profile-every', type=int, default=0, metavar='N', help='profile every Nth run')
+    parser.add_argument('--trace-memory', action='store_true', help='trace allocations, reporting the top allocation sites when rss gets too high')
+    parser.add_argument('--simulate', type=int, default=0, metavar='HOURS', help='simulate this many hours of posting against stand-in apis, then report on timings & load')
+    parser.add_argument('--simulate-start', type=datetime.fromisoformat, default=None, metavar='TIME', help='local time the simulation starts at (defaults to now)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the simulated latencies & failures')
+    args = parser.parse_args()
+
     try:
-        asyncio.run(main())
+        if args.simulate:
+            simulate(args.simulate, args.simulate_start or datetime.now(), args.seed)
+        else:
+            asyncio.run(run(1 if args.profile else args.profile_every, args.trace_memory))
     except KeyboardInterrupt:
         log.info('Exiting...')
         exit()
@@ -1,5 +1,10 @@
-from modules.bluesky import bluesky
-from modules.tumblr import tumblr
-from modules.twitter import twitter
+from modules.bluesky import bluesky, check_bluesky, prepare_bluesky, warm_bluesky
+from modules.tumblr import check_tumblr, tumblr
+from modules.twitter import check_twitter, prepare_twitter, twitter, warm_twitter
 
-__all__ = ['twitter', 'tumblr', 'bluesky']
\ No newline at end of file
+__all__ = [
+    'twitter', 'tumblr', 'bluesky',
+    'prepare_twitter', 'prepare_bluesky',
+    'warm_twitter', 'warm_bluesky',
+    'check_twitter', 'check_tumblr', 'check_bluesky',
+]
\ No newline at end of file
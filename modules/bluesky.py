@@ -1,97 +1,260 @@
+import asyncio
 import traceback
+from typing import Dict
 
-from atproto import Client
+from atproto import AsyncClient, AsyncRequest, Session, models
 from atproto_core.exceptions import AtProtocolError
-from discord import Embed
 
+from utils.alerts import alert, resolve
+from utils.circuit import circuits
+from utils.clock import get_clock
 from utils.config import AnimalConfig
+from utils.constants import BLUESKY_PDS_UPLOAD_CONCURRENCY
+from utils.history import history
+from utils.http import get_httpx_transport
 from utils.image import SourceImage
+from utils.job import PostJob
 from utils.logger import Logger
-from utils.webhook import send_to_webhook
 
 log = Logger("Bluesky")
 
-async def bluesky(source_cfg: AnimalConfig, img: SourceImage, img_url: str) -> str | None:
-    # skip if not enabled
-    if not source_cfg['bluesky']['enabled']:
-        log.info('Bluesky not enabled, skipping')
-        return None
+# logged in clients are kept between runs, so we don't need to log in every hour
+_clients: Dict[str, AsyncClient] = {}
 
-    log.info('Posting to Bluesky')
+# blob uploads are limited per PDS, so accounts hosted on the same PDS take turns
+_pds_upload_slots: Dict[str, asyncio.Semaphore] = {}
+
+def get_upload_slot(bs: AsyncClient) -> asyncio.Semaphore:
+    # the pds the logged in session was resolved to (accounts on bsky.social live on separate pds hosts)
+    pds = Session.decode(bs.export_session_string()).pds_endpoint or 'https://bsky.social'
+    if pds not in _pds_upload_slots:
+        _pds_upload_slots[pds] = asyncio.Semaphore(BLUESKY_PDS_UPLOAD_CONCURRENCY)
+
+    return _pds_upload_slots[pds]
+
+
+async def create_client(source_cfg: AnimalConfig) -> AsyncClient:
+    bs = AsyncClient(request=AsyncRequest(transport=get_httpx_transport()))
+    await bs.login(
+        login = source_cfg['bluesky']['username'],
+        password = source_cfg['bluesky']['app_password']
+    )
+
+    _clients[source_cfg['bluesky']['username']] = bs
+    return bs
+
+
+def forget_client(source_cfg: AnimalConfig):
+    _clients.pop(source_cfg['bluesky']['username'], None)
+
+
+async def login(source_cfg: AnimalConfig) -> AsyncClient | None:
+    # reuse the logged in session from a previous run if we have one
+    cached = _clients.get(source_cfg['bluesky']['username'])
+    if cached is not None:
+        return cached
 
     try:
-        bs = Client()
-        bs.login(
-            login = source_cfg['bluesky']['username'],
-            password = source_cfg['bluesky']['app_password']
-        )
+        return await create_client(source_cfg)
     except AtProtocolError as e:
         log.error('Failed to authenticate - Bluesky API returned an error.', traceback.format_exc())
-        embed = Embed(
-            title='Error',
-            description='Failed to authenticate - Bluesky API returned an error.',
-        )
-        await send_to_webhook(
-            url=source_cfg['webhooks']['bluesky'],
-            content='@everyone',
-            embed=embed,
+        await alert(
+            source_cfg['webhooks']['bluesky'],
+            'Bluesky',
+            source_cfg,
+            'Failed to authenticate - Bluesky API returned an error.',
             exception=e
         )
 
         return None
     except Exception as e:
         log.error('Failed to authenticate:', traceback.format_exc())
-        embed = Embed(
-            title='Error',
-            description='Failed to authenticate.',
+        await alert(
+            source_cfg['webhooks']['bluesky'],
+            'Bluesky',
+            source_cfg,
+            'Failed to authenticate.',
+            exception=e
         )
-        await send_to_webhook(
-            url=source_cfg['webhooks']['bluesky'],
-            content='@everyone',
-            embed=embed,
+
+        return None
+
+
+async def upload_image(job: PostJob) -> bool:
+    source_cfg = job.source_cfg
+
+    bs = await login(source_cfg)
+    if bs is None:
+        return False
+
+    album = job.album('bluesky')
+    slot = get_upload_slot(bs)
+
+    async def upload_blob(img: SourceImage):
+        async with slot:
+            upload_res = await bs.upload_blob(img.read())
+            return upload_res.blob
+
+    log.info(f'Uploading {len(album)} image(s)')
+    try:
+        blobs = await asyncio.gather(*(upload_blob(img) for img in album))
+    except AtProtocolError as e:
+        log.error('Failed to upload image - API returned an error.', traceback.format_exc())
+        # the session may have expired, so log in fresh next time
+        forget_client(source_cfg)
+        await alert(
+            source_cfg['webhooks']['bluesky'],
+            'Bluesky',
+            source_cfg,
+            'Failed to upload image - API returned an error.',
+            exception=e
+        )
+
+        return False
+    except Exception as e:
+        log.error('Failed to upload image:', traceback.format_exc())
+        await alert(
+            source_cfg['webhooks']['bluesky'],
+            'Bluesky',
+            source_cfg,
+            'Failed to upload image.',
             exception=e
         )
 
+        return False
+
+    log.success('Uploaded image!')
+    job.media['bluesky'] = {
+        'client': bs,
+        'blobs': blobs,
+    }
+
+    return True
+
+
+# uploads the image blob ahead of the posting time, so only the record is created on the hour
+async def prepare_bluesky(job: PostJob) -> bool:
+    source_cfg = job.source_cfg
+    if not source_cfg['bluesky']['enabled']:
+        return False
+
+    # only checked here, the outcome is recorded once when posting (which retries a failed upload),
+    # so a bad run only counts as a single failure
+    if circuits.get('Bluesky', source_cfg).is_open():
+        log.warning('Bluesky circuit is open, skipping upload')
+        return False
+
+    start = get_clock().time()
+    uploaded = await upload_image(job)
+    history.record(source_cfg['key'], job.post_time, 'Bluesky', 'upload', start, uploaded, size=job.album_bytes('bluesky'))
+
+    return uploaded
+
+
+async def bluesky(job: PostJob) -> str | None:
+    source_cfg = job.source_cfg
+
+    # skip if not enabled
+    if not source_cfg['bluesky']['enabled']:
+        log.info('Bluesky not enabled, skipping')
+        return None
+
+    breaker = circuits.get('Bluesky', source_cfg)
+    if not breaker.allow():
+        log.warning('Bluesky circuit is open, skipping post')
         return None
 
+    log.info('Posting to Bluesky')
+    start = get_clock().time()
+    link = await create_post(job)
+    breaker.record(link is not None)
+    history.record(source_cfg['key'], job.post_time, 'Bluesky', 'post', start, link is not None, url=link)
+
+    return link
+
+
+async def create_post(job: PostJob) -> str | None:
+    source_cfg = job.source_cfg
+
+    # upload image now if it wasn't done ahead of time
+    if 'bluesky' not in job.media and not await upload_image(job):
+        return None
+
+    bs: AsyncClient = job.media['bluesky']['client']
+    blobs = job.media['bluesky']['blobs']
+
     log.info('Posting image')
     try:
-        post_res = bs.send_image(
+        post_res = await bs.send_post(
             text = "",
-            image = img.read(),
-            image_alt = ""
+            embed = models.AppBskyEmbedImages.Main(
+                images = [models.AppBskyEmbedImages.Image(alt = "", image = blob) for blob in blobs]
+            )
         )
 
         post_id = post_res.uri.split('app.bsky.feed.')[1]
         link = f'https://bsky.app/profile/{source_cfg["bluesky"]["username"]}/{post_id}'
         log.success(f'Posted image to Bluesky! Link: {link}')
+        await resolve('Bluesky', source_cfg)
 
         return link
     except AtProtocolError as e:
         log.error('Failed to post - API returned an error.', traceback.format_exc())
-        embed = Embed(
-            title='Error',
-            description='Failed to post - API returned an error.',
-        )
-        await send_to_webhook(
-            url=source_cfg['webhooks']['bluesky'],
-            content='@everyone',
-            embed=embed,
+        # the session may have expired, so log in fresh next time
+        forget_client(source_cfg)
+        await alert(
+            source_cfg['webhooks']['bluesky'],
+            'Bluesky',
+            source_cfg,
+            'Failed to post - API returned an error.',
             exception=e
         )
 
         return None
     except Exception as e:
         log.error('Failed to post:', traceback.format_exc())
-        embed = Embed(
-            title='Error',
-            description='Failed to post.',
-        )
-        await send_to_webhook(
-            url=source_cfg['webhooks']['bluesky'],
-            content='@everyone',
-            embed=embed,
+        await alert(
+            source_cfg['webhooks']['bluesky'],
+            'Bluesky',
+            source_cfg,
+            'Failed to post.',
             exception=e
         )
 
-        return None
\ No newline at end of file
+        return None
+
+
+# refreshes the session (if needed) & opens a connection to the PDS ahead of the posting time
+async def warm_bluesky(source_cfg: AnimalConfig):
+    if not source_cfg['bluesky']['enabled'] or circuits.get('Bluesky', source_cfg).is_open():
+        return
+
+    bs = await login(source_cfg)
+    if bs is None:
+        return
+
+    try:
+        await bs.com.atproto.server.get_session()
+    except Exception as e:
+        log.warning(f'Failed to warm up session, logging in again next time: {e!r}')
+        forget_client(source_cfg)
+
+
+# checks the credentials by logging in, returning None if the API couldn't be reached
+async def check_bluesky(source_cfg: AnimalConfig) -> bool | None:
+    try:
+        await create_client(source_cfg)
+    except AtProtocolError as e:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        if status in (400, 401, 403):
+            log.error(f'Credentials for "{source_cfg["key"]}" were rejected (status {status}).')
+            return False
+
+        log.warning(f'Could not check credentials for "{source_cfg["key"]}": {e!r}')
+        return None
+    except Exception as e:
+        log.warning(f'Could not check credentials for "{source_cfg["key"]}": {e!r}')
+        return None
+
+    log.success(f'Logged in as {source_cfg["bluesky"]["username"]} for "{source_cfg["key"]}".')
+    return True
@@ -1,89 +1,130 @@
+import asyncio
+import json
 import traceback
+from typing import Any, Dict
 
-import pytumblr
-from discord import Embed
+import aiohttp
 
+from utils.alerts import alert, resolve
+from utils.circuit import circuits
+from utils.clock import get_clock
 from utils.config import AnimalConfig, cfg
-from utils.image import SourceImage
+from utils.history import history
+from utils.http import get_session
+from utils.job import PostJob
 from utils.logger import Logger
-from utils.webhook import send_to_webhook
+from utils.oauth import OAuth1Signer, get_signer
 
 log = Logger("Tumblr")
 
-async def tumblr(source_cfg: AnimalConfig, img: SourceImage, img_url: str) -> str | None:
-    webhook_url = source_cfg['webhooks']['tumblr']
-    blog_name = source_cfg['tumblr']['blogname']
+API_URL = 'https://api.tumblr.com/v2'
+
+def get_tumblr_signer(source_cfg: AnimalConfig) -> OAuth1Signer:
+    return get_signer(
+        source_cfg['tumblr']['consumer_key'],
+        source_cfg['tumblr']['consumer_secret'],
+        source_cfg['tumblr']['oauth_token'],
+        source_cfg['tumblr']['oauth_token_secret']
+    )
+
+
+# creates an NPF photo post (or photoset), sending the encoded images from memory as part of the multipart body
+async def create_photo_post(signer: OAuth1Signer, blog_name: str, job: PostJob) -> Dict[str, Any]:
+    album = job.album('tumblr')
+    post = {
+        'state': 'published',
+        'tags': ','.join(job.source_cfg['tumblr']['tags']),
+        'content': [
+            {
+                'type': 'image',
+                'media': [{ 'type': img.mime_type, 'identifier': f'image{idx}' }],
+            }
+            for idx, img in enumerate(album)
+        ],
+    }
+
+    form = aiohttp.FormData()
+    form.add_field('json', json.dumps(post), content_type='application/json')
+    for idx, img in enumerate(album):
+        form.add_field(f'image{idx}', img.read(), filename=img.path.name, content_type=img.mime_type)
+
+    url, headers = signer.sign('POST', f'{API_URL}/blog/{blog_name}/posts')
+    async with get_session().post(url, headers=headers, data=form) as res:
+        return await res.json(content_type=None)
+
+
+async def tumblr(job: PostJob) -> str | None:
+    source_cfg = job.source_cfg
 
     # skip if not enabled
     if not source_cfg['tumblr']['enabled']:
         log.info('Tumblr not enabled, skipping')
         return None
 
+    breaker = circuits.get('Tumblr', source_cfg)
+    if not breaker.allow():
+        log.warning('Tumblr circuit is open, skipping post')
+        return None
+
     log.info('Posting to Tumblr')
+    start = get_clock().time()
+    post_url = await post_photo(job)
+    breaker.record(post_url is not None)
+    history.record(source_cfg['key'], job.post_time, 'Tumblr', 'post', start, post_url is not None, size=job.album_bytes('tumblr'), url=post_url)
+
+    return post_url
+
+
+async def post_photo(job: PostJob) -> str | None:
+    source_cfg = job.source_cfg
+    webhook_url = source_cfg['webhooks']['tumblr']
+    blog_name = source_cfg['tumblr']['blogname']
 
     try:
-        tumblr = pytumblr.TumblrRestClient(
-            consumer_key = source_cfg['tumblr']['consumer_key'],
-            consumer_secret = source_cfg['tumblr']['consumer_secret'],
-            oauth_token = source_cfg['tumblr']['oauth_token'],
-            oauth_secret = source_cfg['tumblr']['oauth_token_secret']
-        )
+        signer = get_tumblr_signer(source_cfg)
     except Exception as e:
         log.error('An error occurred while authenticating:', traceback.format_exc())
         if webhook_url:
-            embed = Embed(
-                title='Error',
-                description='Failed to authenticate to Tumblr.',
-            )
-            await send_to_webhook(
-                url=webhook_url,
-                content='@everyone',
-                embed=embed,
+            await alert(
+                webhook_url,
+                'Tumblr',
+                source_cfg,
+                'Failed to authenticate to Tumblr.',
                 exception=e
             )
         return None
 
     try:
-        response = tumblr.create_photo(
-            blogname = blog_name,
-            state = "published",
-            tags = source_cfg['tumblr']['tags'],
-            data = img.path
-        )
+        response = await create_photo_post(signer, blog_name, job)
 
         # check if error
-        if response.get('meta', {}).get('status'):
-            status = response.get("meta", {}).get("status", "Unknown")
-            status_msg = response.get("meta", {}).get("msg", "Unknown")
+        status = response.get('meta', {}).get('status', 'Unknown')
+        if not isinstance(status, int) or status >= 300:
+            status_msg = response.get('meta', {}).get('msg', 'Unknown')
             error = response.get('response', 'Unknown')
-            if error == 'You cannot post to this blog':
+            error_details = [str(err.get('detail', '')) for err in response.get('errors', [])]
+            if error == 'You cannot post to this blog' or any('cannot post to this blog' in detail for detail in error_details):
                 log.error('You have either set the incorrect blogname value, or you have authorized the app to the wrong account. Tumblr has now been disabled, so please re-check config.json and try again.')
                 source_cfg['tumblr']['enabled'] = False
                 cfg.save()
 
                 if webhook_url:
-                    embed = Embed(
-                        title='Error',
-                        description='Failed to post - the configured blog name is incorrect.',
-                    )
-                    await send_to_webhook(
-                        url=webhook_url,
-                        content='@everyone',
-                        embed=embed,
+                    await alert(
+                        webhook_url,
+                        'Tumblr',
+                        source_cfg,
+                        'Failed to post - the configured blog name is incorrect.',
                         response=response
                     )
                 return None
 
-            log.error(f'An error occurred while posting the image (status: {status}, {status_msg}): {error}')
+            log.error(f'An error occurred while posting the image (status: {status}, {status_msg}): {error_details or error}')
             if webhook_url:
-                embed = Embed(
-                    title='Error',
-                    description='Failed to post - Tumblr returned an error.',
-                )
-                await send_to_webhook(
-                    url=webhook_url,
-                    content='@everyone',
-                    embed=embed,
+                await alert(
+                    webhook_url,
+                    'Tumblr',
+                    source_cfg,
+                    'Failed to post - Tumblr returned an error.',
                     response=response
                 )
 
@@ -92,20 +133,55 @@ async def tumblr(source_cfg: AnimalConfig, img: SourceImage, img_url: str) -> st
         log.error('An error occurred while posting the image:', traceback.format_exc())
 
         if webhook_url:
-            embed = Embed(
-                title='Error',
-                description='Failed to post.',
-            )
-            await send_to_webhook(
-                url=webhook_url,
-                content='@everyone',
-                embed=embed,
+            await alert(
+                webhook_url,
+                'Tumblr',
+                source_cfg,
+                'Failed to post.',
                 exception=e
             )
 
         return None
 
-    post_url = f'https://{blog_name}.tumblr.com/post/{response["id"]}'
+    post_url = f'https://{blog_name}.tumblr.com/post/{response["response"]["id"]}'
     log.success(f'Posted image to Tumblr! Link: {post_url}')
+    await resolve('Tumblr', source_cfg)
+
+    return post_url
+
+
+# checks the credentials against the API & that they can post to the configured blog,
+# returning None if it couldn't be reached
+async def check_tumblr(source_cfg: AnimalConfig) -> bool | None:
+    blog_name = source_cfg['tumblr']['blogname']
+    url, headers = get_tumblr_signer(source_cfg).sign('GET', f'{API_URL}/user/info')
+
+    try:
+        async with get_session().get(url, headers=headers) as res:
+            if res.status in (401, 403):
+                log.error(f'Credentials for "{source_cfg["key"]}" were rejected (status {res.status}).')
+                return False
+
+            if res.status >= 300:
+                log.warning(f'Could not check credentials for "{source_cfg["key"]}" (status {res.status}).')
+                return None
+
+            data = await res.json(content_type=None)
+    # a body that isn't json (e.g. a captive portal or proxy error page) means we didn't reach the api
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        log.warning(f'Could not check credentials for "{source_cfg["key"]}": {e!r}')
+        return None
+
+    response = data.get('response') if isinstance(data, dict) else None
+    user = response.get('user') if isinstance(response, dict) else None
+    if not isinstance(user, dict) or not isinstance(user.get('blogs', []), list):
+        log.warning(f'Could not check credentials for "{source_cfg["key"]}": unexpected response.')
+        return None
+
+    blogs = [blog.get('name') for blog in user.get('blogs', []) if isinstance(blog, dict)]
+    if blog_name not in blogs:
+        log.error(f'The account for "{source_cfg["key"]}" can\'t post to the blog "{blog_name}" (it has: {", ".join(blogs) or "none"}).')
+        return False
 
-    return post_url
\ No newline at end of file
+    log.success(f'Authenticated with access to "{blog_name}" for "{source_cfg["key"]}".')
+    return True
@@ -1,115 +1,250 @@
+import asyncio
 import traceback
-from datetime import datetime
+from typing import Any, Dict, List
 
+import aiohttp
 import tweepy
-from discord import Embed
 from tweepy import errors
 
+from utils.alerts import alert, resolve
+from utils.circuit import circuits
+from utils.clock import get_clock
 from utils.config import AnimalConfig
+from utils.constants import REQUEST_TIMEOUT, TWITTER_UPLOAD_CHUNK_SIZE, TWITTER_UPLOAD_CONCURRENCY, TWITTER_UPLOAD_STATUS_MAX_WAIT
+from utils.history import history
+from utils.http import get_session, mount_stand_in
 from utils.image import SourceImage
+from utils.job import PostJob
 from utils.logger import Logger
-from utils.webhook import send_to_webhook
+from utils.oauth import OAuth1Signer, get_signer
 
 log = Logger("Twitter")
 
+API_URL = 'https://api.twitter.com/2'
+UPLOAD_URL = 'https://upload.twitter.com/1.1/media/upload.json'
+
+# clients are kept between runs so their connections stay open
+_clients: Dict[str, tweepy.Client] = {}
+
+class TwitterUploadError(Exception):
+    response: Dict[str, Any] | None
+
+    def __init__(self, message: str, response: Dict[str, Any] | None = None):
+        super().__init__(message)
+        self.response = response
+
+
+def get_twitter_signer(source_cfg: AnimalConfig) -> OAuth1Signer:
+    return get_signer(
+        source_cfg['twitter']['consumer_key'],
+        source_cfg['twitter']['consumer_secret'],
+        source_cfg['twitter']['access_token'],
+        source_cfg['twitter']['access_token_secret']
+    )
+
+
+def get_client(source_cfg: AnimalConfig) -> tweepy.Client:
+    access_token = source_cfg['twitter']['access_token']
+    if access_token not in _clients:
+        _clients[access_token] = tweepy.Client(
+            consumer_key=source_cfg['twitter']['consumer_key'],
+            consumer_secret=source_cfg['twitter']['consumer_secret'],
+            access_token=access_token,
+            access_token_secret=source_cfg['twitter']['access_token_secret']
+        )
+        mount_stand_in(_clients[access_token].session)
+
+    return _clients[access_token]
+
+
 # current API ratelimit says max of 17 every 24hrs, therefore we need to post every 2h instead of hourly
-async def twitter(source_cfg: AnimalConfig, img: SourceImage, img_url: str) -> str | None:
+def should_post(job: PostJob) -> bool:
+    # only post on even hours (0, 2, 4, ...)
+    return job.post_time.hour % 2 == 0
+
+
+async def upload_request(signer: OAuth1Signer, method: str, params: Dict[str, str], data: aiohttp.FormData | None = None) -> Dict[str, Any] | None:
+    url, headers = signer.sign(method, UPLOAD_URL, params=params)
+
+    async with get_session().request(method, url, headers=headers, data=data) as res:
+        body = await res.json(content_type=None) if res.status != 204 else None
+        if res.status >= 300:
+            raise TwitterUploadError(f'Media upload {params["command"]} failed with status code {res.status}', body)
+
+        return body
+
+
+# a native version of the chunked upload flow (INIT -> APPEND -> FINALIZE -> STATUS),
+# sending the APPEND segments concurrently straight from the encoded image in memory
+async def upload_media(signer: OAuth1Signer, img: SourceImage) -> str:
+    data = img.read()
+
+    init_res = await upload_request(signer, 'POST', {
+        'command': 'INIT',
+        'total_bytes': str(len(data)),
+        'media_type': img.mime_type,
+        'media_category': 'tweet_image',
+    })
+    if not init_res or 'media_id_string' not in init_res:
+        raise TwitterUploadError('Media upload INIT did not return a media id', init_res)
+
+    media_id = init_res['media_id_string']
+
+    semaphore = asyncio.Semaphore(TWITTER_UPLOAD_CONCURRENCY)
+    async def append(segment_index: int, chunk: bytes):
+        form = aiohttp.FormData()
+        form.add_field('media', chunk, filename='media', content_type='application/octet-stream')
+
+        async with semaphore:
+            await upload_request(signer, 'POST', {
+                'command': 'APPEND',
+                'media_id': media_id,
+                'segment_index': str(segment_index),
+            }, form)
+
+    chunks = [data[i:i + TWITTER_UPLOAD_CHUNK_SIZE] for i in range(0, len(data), TWITTER_UPLOAD_CHUNK_SIZE)]
+    await asyncio.gather(*(append(idx, chunk) for idx, chunk in enumerate(chunks)))
+
+    finalize_res = await upload_request(signer, 'POST', {
+        'command': 'FINALIZE',
+        'media_id': media_id,
+    })
+
+    # wait for twitter to finish processing the media if it hasn't already
+    processing_info = (finalize_res or {}).get('processing_info')
+    waited = 0
+    while processing_info and processing_info.get('state') in ('pending', 'in_progress'):
+        check_after = processing_info.get('check_after_secs', 1)
+        if waited + check_after > TWITTER_UPLOAD_STATUS_MAX_WAIT:
+            raise TwitterUploadError('Timed out waiting for media processing', processing_info)
+
+        await asyncio.sleep(check_after)
+        waited += check_after
+
+        status_res = await upload_request(signer, 'GET', {
+            'command': 'STATUS',
+            'media_id': media_id,
+        })
+        processing_info = (status_res or {}).get('processing_info')
+
+    if processing_info and processing_info.get('state') == 'failed':
+        raise TwitterUploadError('Media processing failed', processing_info)
+
+    return media_id
+
+
+async def upload_images(job: PostJob) -> List[str] | None:
+    source_cfg = job.source_cfg
+    webhook_url = source_cfg['webhooks']['twitter']
+    signer = get_twitter_signer(source_cfg)
+    album = job.album('twitter')
+
+    log.info(f'Uploading {len(album)} image(s)')
+    try:
+        media_ids = list(await asyncio.gather(*(upload_media(signer, img) for img in album)))
+    except Exception as e:
+        log.error('An error occured while uploading the image:', traceback.format_exc())
+
+        await alert(
+            webhook_url,
+            'Twitter',
+            source_cfg,
+            'Failed to upload image to Twitter.',
+            exception=e,
+            response=e.response if isinstance(e, TwitterUploadError) else None
+        )
+
+        return None
+
+    log.success('Uploaded image!')
+    job.media['twitter'] = media_ids
+    return media_ids
+
+
+# uploads the image ahead of the posting time, so only the tweet itself is sent on the hour
+async def prepare_twitter(job: PostJob) -> List[str] | None:
+    source_cfg = job.source_cfg
+    if not source_cfg['twitter']['enabled'] or not should_post(job):
+        return None
+
+    # only checked here, the outcome is recorded once when posting (which retries a failed upload),
+    # so a bad run only counts as a single failure
+    if circuits.get('Twitter', source_cfg).is_open():
+        log.warning('Twitter circuit is open, skipping upload')
+        return None
+
+    start = get_clock().time()
+    media_ids = await upload_images(job)
+    history.record(source_cfg['key'], job.post_time, 'Twitter', 'upload', start, media_ids is not None, size=job.album_bytes('twitter'))
+
+    return media_ids
+
+
+async def twitter(job: PostJob) -> str | None:
+    source_cfg = job.source_cfg
+
     # skip if not enabled
     if not source_cfg['twitter']['enabled']:
         log.info('Twitter not enabled, skipping')
         return None
 
-    webhook_url = source_cfg['webhooks']['twitter']
-
-    # only post on even hours (0, 2, 4, ...)
-    current_hour = datetime.now().hour
-    if current_hour % 2 != 0:
+    if not should_post(job):
         log.info('Skipping Twitter post for this hour - posting in even hours only due to rate limits.')
         return None
 
-    log.info('Posting to Twitter')
+    breaker = circuits.get('Twitter', source_cfg)
+    if not breaker.allow():
+        log.warning('Twitter circuit is open, skipping post')
+        return None
 
-    try:
-        consumer_key = source_cfg['twitter']['consumer_key']
-        consumer_secret = source_cfg['twitter']['consumer_secret']
-        access_token = source_cfg['twitter']['access_token']
-        access_token_secret = source_cfg['twitter']['access_token_secret']
-
-        auth = tweepy.OAuth1UserHandler(
-            consumer_key = consumer_key,
-            consumer_secret = consumer_secret,
-            access_token = access_token,
-            access_token_secret = access_token_secret
-        )
+    log.info('Posting to Twitter')
+    start = get_clock().time()
+    tweet_url = await post_tweet(job)
+    breaker.record(tweet_url is not None)
+    history.record(source_cfg['key'], job.post_time, 'Twitter', 'post', start, tweet_url is not None, url=tweet_url)
 
-        v1 = tweepy.API(auth)
-        v2 = tweepy.Client(
-            consumer_key=consumer_key,
-            consumer_secret=consumer_secret,
-            access_token=access_token,
-            access_token_secret=access_token_secret
-        )
-    except Exception as e:
-        log.error('An error occurred while authenticating:', traceback.format_exc())
+    return tweet_url
 
-        embed = Embed(
-            title='Error',
-            description='Failed to authenticate.',
-        )
-        await send_to_webhook(
-            url=webhook_url,
-            content='@everyone',
-            embed=embed,
-            exception=e
-        )
 
-        return None
+async def post_tweet(job: PostJob) -> str | None:
+    source_cfg = job.source_cfg
+    webhook_url = source_cfg['webhooks']['twitter']
 
-    # upload image
-    log.info('Uploading image')
-    upload_res = None
-    media_id = None
     try:
-        upload_res = v1.chunked_upload(
-            filename=str(img.path),
-            media_category="tweet_image"
-        )
-        media_id = upload_res.media_id_string
+        v2 = get_client(source_cfg)
     except Exception as e:
-        log.error('An error occured while uploading the image:', traceback.format_exc())
+        log.error('An error occurred while authenticating:', traceback.format_exc())
 
-        embed = Embed(
-            title='Error',
-            description='Failed to upload image to Twitter.',
-        )
-        await send_to_webhook(
-            url=webhook_url,
-            content='@everyone',
-            embed=embed,
-            exception=e,
-            response=upload_res
+        await alert(
+            webhook_url,
+            'Twitter',
+            source_cfg,
+            'Failed to authenticate.',
+            exception=e
         )
 
         return None
 
-    log.success('Uploaded image!')
+    # upload image now if it wasn't done ahead of time
+    media_ids = job.media.get('twitter')
+    if media_ids is None:
+        media_ids = await upload_images(job)
+        if media_ids is None:
+            return None
 
     # post image
     log.info('Posting image')
     post_res = None
     try:
-        post_res = v2.create_tweet(text = "", media_ids = [ media_id ])
+        post_res = await asyncio.to_thread(v2.create_tweet, text = "", media_ids = media_ids)
     except errors.TooManyRequests as e:
         log.error('Rate limit exceeded! Skipping post')
 
-        embed = Embed(
-            title='Error',
-            description='Failed to post - Rate limit exceeded.',
-        )
-        await send_to_webhook(
-            url=webhook_url,
-            content='@everyone',
-            embed=embed,
+        await alert(
+            webhook_url,
+            'Twitter',
+            source_cfg,
+            'Failed to post - Rate limit exceeded.',
             exception=e,
             response=post_res
         )
@@ -118,14 +253,11 @@ async def twitter(source_cfg: AnimalConfig, img: SourceImage, img_url: str) -> s
     except Exception as e:
         log.error('An error occured while posting the image:', traceback.format_exc())
 
-        embed = Embed(
-            title='Error',
-            description='Failed to post.',
-        )
-        await send_to_webhook(
-            url=webhook_url,
-            content='@everyone',
-            embed=embed,
+        await alert(
+            webhook_url,
+            'Twitter',
+            source_cfg,
+            'Failed to post.',
             exception=e,
             response=post_res
         )
@@ -136,21 +268,61 @@ async def twitter(source_cfg: AnimalConfig, img: SourceImage, img_url: str) -> s
     if post_res and post_res.data and not post_res.errors: # type: ignore
         tweet_url = f'https://x.com/i/status/{post_res.data["id"]}' # type: ignore
         log.success(f'Posted image to Twitter! Link: {tweet_url}')
+        await resolve('Twitter', source_cfg)
 
         return tweet_url
     else:
         response_errors = post_res.errors if post_res else None # type: ignore
         log.error('An error occurred while posting the image:', response_errors)
 
-        embed = Embed(
-            title='Error',
-            description='Failed to post.',
-        )
-        await send_to_webhook(
-            url=webhook_url,
-            content='@everyone',
-            embed=embed,
+        await alert(
+            webhook_url,
+            'Twitter',
+            source_cfg,
+            'Failed to post.',
             response=post_res
         )
 
-        return None
\ No newline at end of file
+        return None
+
+
+# opens the tweet client's connection ahead of the posting time, if the job is going to be tweeted
+async def warm_twitter(job: PostJob):
+    source_cfg = job.source_cfg
+    if not source_cfg['twitter']['enabled'] or not should_post(job) or circuits.get('Twitter', source_cfg).is_open():
+        return
+
+    try:
+        client = get_client(source_cfg)
+        await asyncio.to_thread(client.session.head, f'{API_URL}/', timeout=REQUEST_TIMEOUT)
+    except Exception as e:
+        log.warning(f'Failed to warm up connection: {e!r}')
+
+
+# checks the credentials against the API, returning None if it couldn't be reached
+async def check_twitter(source_cfg: AnimalConfig) -> bool | None:
+    url, headers = get_twitter_signer(source_cfg).sign('GET', f'{API_URL}/users/me')
+
+    try:
+        async with get_session().get(url, headers=headers) as res:
+            if res.status in (401, 403):
+                log.error(f'Credentials for "{source_cfg["key"]}" were rejected (status {res.status}).')
+                return False
+
+            if res.status >= 300:
+                log.warning(f'Could not check credentials for "{source_cfg["key"]}" (status {res.status}).')
+                return None
+
+            data = await res.json(content_type=None)
+    # a body that isn't json (e.g. a captive portal or proxy error page) means we didn't reach the api
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        log.warning(f'Could not check credentials for "{source_cfg["key"]}": {e!r}')
+        return None
+
+    user = data.get('data') if isinstance(data, dict) else None
+    if not isinstance(user, dict):
+        log.warning(f'Could not check credentials for "{source_cfg["key"]}": unexpected response.')
+        return None
+
+    log.success(f'Authenticated as @{user.get("username", "unknown")} for "{source_cfg["key"]}".')
+    return True
@@ -1,7 +1,70 @@
+import asyncio
+import math
 from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, List, Set
 
+import filetype
+
+from utils.clock import get_clock
 from utils.config import AnimalType, Config
+from utils.constants import (
+  ENDPOINT_DEGRADED_LATENCY_SECONDS,
+  ENDPOINT_EWMA_ALPHA,
+  ENDPOINT_MAX_ERROR_RATE,
+  ENDPOINT_PROBE_INTERVAL_SECONDS,
+  HEDGE_DEFAULT_DELAY_SECONDS,
+  HEDGE_LATENCY_PERCENTILE,
+  HEDGE_LATENCY_WINDOW,
+  HEDGE_MIN_DELAY_SECONDS,
+  IMG_EXTENSIONS,
+  MAX_IMG_FETCH_RETRY,
+  QUALITY_PREFILTER_ENABLED,
+  REQUEST_TIMEOUT,
+)
 from utils.logger import Logger
+from utils.quality import score
+
+FetchResult = tuple[bytes | None, str | None]
+
+# an upstream endpoint for a source, scored by rolling (ewma) latency & error rate
+class Endpoint:
+  url: str
+  latency: float
+  error_rate: float
+  samples: int
+  in_flight: int
+
+  def __init__(self, url: str):
+    self.url = url
+    self.latency = 0
+    self.error_rate = 0
+    self.samples = 0
+    self.in_flight = 0
+
+  def record(self, latency: float, ok: bool):
+    if self.samples == 0:
+      self.latency = latency
+      self.error_rate = 0 if ok else 1
+    else:
+      self.latency += ENDPOINT_EWMA_ALPHA * (latency - self.latency)
+      self.error_rate += ENDPOINT_EWMA_ALPHA * ((0 if ok else 1) - self.error_rate)
+
+    self.samples += 1
+
+  def is_healthy(self) -> bool:
+    return self.error_rate <= ENDPOINT_MAX_ERROR_RATE
+
+  def is_degraded(self) -> bool:
+    return not self.is_healthy() or self.latency > ENDPOINT_DEGRADED_LATENCY_SECONDS
+
+  # forgets the score, so the endpoint is judged on its next requests alone
+  def reset(self):
+    self.latency = 0
+    self.error_rate = 0
+    self.samples = 0
+
 
 class ImageSource(ABC):
   cfg: Config
@@ -10,21 +73,202 @@ class ImageSource(ABC):
   name: str
   url: str
   logger: Logger
+  latencies: Deque[float]
+  endpoints: List[Endpoint]
+  fallback: 'ImageSource | None'
+  # total fetch attempts made, including hedges & retries
+  attempts: int
+  # when a degraded source was last tried despite having a fallback
+  last_probe: float
 
-  def __init__(self, cfg: Config, cfg_key: AnimalType):
+  def __init__(self, cfg: Config, cfg_key: AnimalType, endpoints: List[str]):
     self.cfg = cfg
     self.cfg_key = cfg_key
+    self.latencies = deque(maxlen=HEDGE_LATENCY_WINDOW)
+    self.endpoints = [Endpoint(url) for url in endpoints]
+    self.url = endpoints[0] if endpoints else ''
+    self.fallback = None
+    self.attempts = 0
+    self.last_probe = 0
 
   @abstractmethod
-  def fetch_img(self) -> tuple[bytes | None, str | None]:
+  async def fetch_img(self, endpoint: str) -> FetchResult:
     pass
 
   @abstractmethod
-  def fetch_img_url(self) -> str:
+  async def fetch_img_url(self, endpoint: str) -> str | None:
     pass
 
+  # fetch attempts made by this source & its fallback
+  def total_attempts(self) -> int:
+    return self.attempts + (self.fallback.attempts if self.fallback is not None else 0)
+
+  # routes to the fastest healthy endpoint, preferring ones that aren't already busy with a hedged attempt
+  def pick_endpoint(self) -> Endpoint:
+    healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy()]
+    candidates = healthy or self.endpoints
+
+    return min(candidates, key=lambda endpoint: (endpoint.in_flight, endpoint.latency if healthy else endpoint.error_rate))
+
+  def is_degraded(self) -> bool:
+    return all(endpoint.samples > 0 and endpoint.is_degraded() for endpoint in self.endpoints)
+
+  # a pre-encoded version of an image this source returned, if it has one
+  def get_rendition(self, img_url: str, profile: str, max_size_mb: float) -> bytes | None:
+    if self.fallback is not None:
+      return self.fallback.get_rendition(img_url, profile, max_size_mb)
+
+    return None
+
+  def is_valid_img(self, img_data: bytes | None) -> bool:
+    if not img_data or len(img_data) == 0:
+      self.logger.error(f'Failed to fetch image from "{self.cfg_key}" ("{self.name}").')
+      return False
+
+    img_type = filetype.guess(img_data)
+    if img_type is None or img_type.extension not in IMG_EXTENSIONS:
+      self.logger.error(f'Source "{self.cfg_key}" ("{self.name}") returned an invalid image.')
+      return False
+
+    return True
+
+  # how long to wait on an attempt before starting a second one in parallel
+  def hedge_delay(self) -> float:
+    if len(self.latencies) < 5:
+      return HEDGE_DEFAULT_DELAY_SECONDS
+
+    ordered = sorted(self.latencies)
+    idx = min(len(ordered) - 1, math.ceil(HEDGE_LATENCY_PERCENTILE * len(ordered)) - 1)
+    return min(max(ordered[idx], HEDGE_MIN_DELAY_SECONDS), REQUEST_TIMEOUT)
+
+  async def fetch_valid_img(self) -> FetchResult:
+    loop = asyncio.get_running_loop()
+    endpoint = self.pick_endpoint()
+    endpoint.in_flight += 1
+    start = loop.time()
+
+    try:
+      img_data, img_url = await self.fetch_img(endpoint.url)
+    except asyncio.CancelledError:
+      # lost a hedge race, so it took at least this long. only count that when it's slower than usual,
+      # otherwise the cut short time would make the slow endpoint look faster
+      elapsed = loop.time() - start
+      if elapsed > endpoint.latency:
+        endpoint.record(elapsed, True)
+      raise
+    finally:
+      endpoint.in_flight -= 1
+
+    latency = loop.time() - start
+    valid = self.is_valid_img(img_data)
+    endpoint.record(latency, valid)
+
+    if not valid or img_data is None:
+      return None, None
+
+    # reject bad images before they go through the full encode
+    if QUALITY_PREFILTER_ENABLED:
+      quality = await asyncio.to_thread(score, img_data)
+      if not quality.passed:
+        self.logger.warning(f'Source "{self.cfg_key}" ("{self.name}") returned a low quality image: {quality}')
+        return None, None
+
+    self.latencies.append(latency)
+    return img_data, img_url
+
+  # fetches from this source, failing over to the fallback source when this one is degraded or fails entirely
+  async def fetch_img_routed(self, deadline: datetime) -> FetchResult:
+    if self.fallback is not None and self.is_degraded():
+      # every so often let a single attempt through, so a recovered source gets used again
+      now = get_clock().monotonic()
+      if now - self.last_probe >= ENDPOINT_PROBE_INTERVAL_SECONDS:
+        self.last_probe = now
+        self.logger.info(f'"{self.name}" is degraded, probing it once before using the fallback.')
+
+        # don't let a hanging probe eat into the time left for the fallback
+        probe_deadline = min(deadline, get_clock().now() + timedelta(seconds=REQUEST_TIMEOUT))
+        img_data, img_url = await self.fetch_img_hedged(probe_deadline, max_attempts=1)
+        if img_data is not None:
+          self.logger.success(f'"{self.name}" has recovered.')
+          for endpoint in self.endpoints:
+            if endpoint.is_degraded():
+              endpoint.reset()
+
+          return img_data, img_url
+
+      self.logger.warning(f'"{self.name}" is degraded, using fallback source "{self.fallback.name}".')
+      return await self.fallback.fetch_img_hedged(deadline)
+
+    img_data, img_url = await self.fetch_img_hedged(deadline)
+    if img_data is None and self.fallback is not None and get_clock().now() < deadline:
+      self.logger.warning(f'Failed to fetch from "{self.name}", using fallback source "{self.fallback.name}".')
+      return await self.fallback.fetch_img_hedged(deadline)
+
+    return img_data, img_url
+
+  # fetches an image, starting another attempt in parallel whenever the current ones are slower
+  # than usual (or fail), and returns whichever valid image arrives first
+  async def fetch_img_hedged(self, deadline: datetime, max_attempts: int = MAX_IMG_FETCH_RETRY) -> FetchResult:
+    loop = asyncio.get_running_loop()
+    end_time = loop.time() + deadline.timestamp() - get_clock().time()
+
+    attempts = 0
+    pending: Set[asyncio.Task[FetchResult]] = set()
+
+    def start_attempt():
+      nonlocal attempts
+      attempts += 1
+      self.attempts += 1
+      pending.add(asyncio.create_task(self.fetch_valid_img()))
+
+    start_attempt()
+
+    try:
+      while pending:
+        remaining = end_time - loop.time()
+        if remaining <= 0:
+          self.logger.error(f'Deadline reached while fetching image from "{self.cfg_key}" ("{self.name}").')
+          return None, None
+
+        timeout = min(self.hedge_delay(), remaining) if attempts < max_attempts else remaining
+        done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+        # nothing finished in time, so hedge with another attempt
+        if not done:
+          if attempts < max_attempts:
+            self.logger.warning(f'Image fetch is slow, starting another attempt ({attempts + 1}/{max_attempts})')
+            start_attempt()
+
+          continue
+
+        for task in done:
+          pending.discard(task)
+
+          try:
+            img_data, img_url = task.result()
+          except Exception as e:
+            self.logger.error(f'Image fetch attempt failed: {e!r}')
+            img_data, img_url = None, None
+
+          if img_data is not None:
+            return img_data, img_url
+
+          if attempts < max_attempts:
+            self.logger.info(f'Retrying ({attempts + 1}/{max_attempts})')
+            start_attempt()
+
+      return None, None
+    finally:
+      # cancel whichever attempts lost the race
+      for task in pending:
+        task.cancel()
+
+      if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
 
 from sources.catapi import CatAPI
 from sources.dogapi import DogAPI
+from sources.library import LocalLibrary
 
-__all__ = ['ImageSource', 'CatAPI', 'DogAPI']
\ No newline at end of file
+__all__ = ['ImageSource', 'CatAPI', 'DogAPI', 'LocalLibrary']
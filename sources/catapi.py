@@ -1,55 +1,66 @@
-from copy import deepcopy
+import asyncio
 
-import requests
+import aiohttp
 
 from sources import ImageSource
+from utils.cache import image_cache
 from utils.config import Config
-from utils.constants import BASE_HEADERS, REQUEST_TIMEOUT
+from utils.http import get_session
 from utils.logger import Logger
 
 
 class CatAPI(ImageSource):
   def __init__(self, cfg: Config):
-    super().__init__(cfg, 'cat')
+    super().__init__(cfg, 'cat', cfg.cfg['cat']['endpoints'])
 
     self.name = 'TheCatAPI'
-    self.url = 'https://api.thecatapi.com/v1/images/search?mime_types=jpg,png'
     self.logger = Logger(self.name)
 
-  def fetch_img(self) -> tuple[bytes | None, str | None]:
+  async def fetch_img(self, endpoint: str) -> tuple[bytes | None, str | None]:
     # get url
-    url = self.fetch_img_url()
+    url = await self.fetch_img_url(endpoint)
     if not url:
-      self.logger.error(f'Failed to fetch image from {self.url}: No URL was returned.')
+      self.logger.error(f'Failed to fetch image from {endpoint}: No URL was returned.')
       return None, None
 
     self.logger.success(f'Fetched image! Got: {url}')
 
-    # fetch image
-    res = requests.get(url, headers = BASE_HEADERS, timeout = REQUEST_TIMEOUT)
-    if res.status_code != 200:
-      self.logger.error(f'Failed to fetch image from {self.url}: Status code {res.status_code}\n{res.text}')
-      return None, None
+    # fetch image, unless we've already downloaded it before (off the event loop, as the cache does disk io)
+    cached = await asyncio.to_thread(image_cache.get_url, url)
+    if cached is not None:
+      self.logger.info('Using cached image data')
+      return cached, url
+
+    try:
+      async with get_session().get(url) as res:
+        if res.status != 200:
+          self.logger.error(f'Failed to fetch image from {url}: Status code {res.status}\n{await res.text()}')
+          return None, None
 
-    return res.content, url
+        data = await res.read()
+        await asyncio.to_thread(image_cache.put_url, url, data)
 
-  def fetch_img_url(self) -> str:
+        return data, url
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      self.logger.error(f'Failed to fetch image from {url}: {e!r}')
+      return None, None
+
+  async def fetch_img_url(self, endpoint: str) -> str | None:
     cfg = self.cfg.cfg[self.cfg_key]
-    headers = deepcopy(BASE_HEADERS)
-    headers['x-api-key'] = cfg['api_key']
+    headers = {'x-api-key': cfg['api_key']}
 
-    self.logger.info(f'Fetching image from {self.url}')
-    res = requests.get(
-      url = self.url,
-      headers = headers
-    )
+    self.logger.info(f'Fetching image from {endpoint}')
 
-    # catapi returns a list of images
     try:
-      data = res.json()
+      async with get_session().get(endpoint, headers = headers) as res:
+        data = await res.json(content_type = None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      self.logger.error(f'Failed to fetch image from {endpoint}: {e!r}')
+      return None
     except Exception:
-      return
+      return None
 
+    # catapi returns a list of images
     if isinstance(data, list):
       data = data[0]
 
@@ -0,0 +1,224 @@
+import json
+import mmap
+import random
+import struct
+import sys
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List
+
+import filetype
+from PIL import Image
+
+from sources import ImageSource
+from utils.cache import hash_bytes
+from utils.config import AnimalType, Config
+from utils.constants import ENCODER_PROFILE, IMG_EXTENSIONS, MAX_IMG_SIZE_MB, QUALITY_BATCH_SIZE, QUALITY_PREFILTER_ENABLED
+from utils.image import SourceImage
+from utils.logger import Logger
+from utils.quality import score_batch
+
+# a packed library is every image & rendition back to back, followed by the json index,
+# then a footer with the offset of the index & a magic marker
+PACK_MAGIC = b'HAPLIB01'
+PACK_FOOTER = struct.Struct('<Q8s')
+INDEX_FILE = 'index.json'
+RENDITIONS_DIR = '.renditions'
+
+def rendition_key(profile: str, max_size_mb: float) -> str:
+  return f'{profile}:{max_size_mb}'
+
+
+# an image source backed by a local, pre-indexed library of images (a directory or a single pack file)
+class LocalLibrary(ImageSource):
+  path: Path
+  packed: bool
+  images: List[Dict[str, Any]]
+  by_hash: Dict[str, Dict[str, Any]]
+  remaining: List[int]
+  _file: BinaryIO | None
+  _mmap: mmap.mmap | None
+
+  def __init__(self, cfg: Config, cfg_key: AnimalType, path: str):
+    super().__init__(cfg, cfg_key, [path])
+
+    self.path = Path(path)
+    self.name = f'Library ({self.path.name})'
+    self.logger = Logger(self.name)
+    self.packed = self.path.is_file()
+    self._file = None
+    self._mmap = None
+
+    self.load()
+
+  def load(self):
+    if self.packed:
+      self._file = open(self.path, 'rb')
+      self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+      index_offset, magic = PACK_FOOTER.unpack(self._mmap[-PACK_FOOTER.size:])
+      if magic != PACK_MAGIC:
+        raise ValueError(f'{self.path} is not an image library pack')
+
+      index = json.loads(self._mmap[index_offset:-PACK_FOOTER.size])
+    else:
+      with open(self.path / INDEX_FILE, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+
+    self.images = index['images']
+    self.by_hash = {entry['hash']: entry for entry in self.images}
+    self.remaining = []
+    self.logger.info(f'Loaded {len(self.images)} images from {self.path}')
+
+  def close(self):
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
+
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  # reads a blob, either from the pack or from a file in the library directory
+  def read_blob(self, blob: Dict[str, Any]) -> bytes:
+    if self._mmap is not None:
+      return self._mmap[blob['offset']:blob['offset'] + blob['size']]
+
+    # the caller needs its own bytes anyway, so a plain read (mapping the file would only add a copy)
+    with open(self.path / blob['path'], 'rb') as f:
+      return f.read()
+
+  # random selection without replacement, starting over once every image has been used
+  def pick(self) -> Dict[str, Any] | None:
+    if not self.images:
+      return None
+
+    if not self.remaining:
+      self.remaining = list(range(len(self.images)))
+
+    idx = random.randrange(len(self.remaining))
+    self.remaining[idx], self.remaining[-1] = self.remaining[-1], self.remaining[idx]
+    return self.images[self.remaining.pop()]
+
+  async def fetch_img(self, endpoint: str) -> tuple[bytes | None, str | None]:
+    url = await self.fetch_img_url(endpoint)
+    if not url:
+      self.logger.error(f'Failed to fetch image from {endpoint}: The library is empty.')
+      return None, None
+
+    entry = self.by_hash[url.removeprefix('library://')]
+    return self.read_blob(entry), url
+
+  async def fetch_img_url(self, endpoint: str) -> str | None:
+    entry = self.pick()
+    if entry is None:
+      return None
+
+    return f'library://{entry["hash"]}'
+
+  def get_rendition(self, img_url: str, profile: str, max_size_mb: float) -> bytes | None:
+    entry = self.by_hash.get(img_url.removeprefix('library://'))
+    if entry is None:
+      return super().get_rendition(img_url, profile, max_size_mb)
+
+    blob = entry['renditions'].get(rendition_key(profile, max_size_mb))
+    if blob is None:
+      return None
+
+    return self.read_blob(blob)
+
+
+# builds a library from a directory of images, either in place (index.json + renditions next to the images)
+# or as a single pack file
+def build(src_dir: str, output: str | None = None, profiles: List[str] | None = None, max_size_mb: float = MAX_IMG_SIZE_MB):
+  log = Logger("Library")
+  if profiles is None:
+    profiles = [ENCODER_PROFILE]
+
+  src = Path(src_dir)
+  pack = open(output, 'wb') if output else None
+
+  images: List[Dict[str, Any]] = []
+  seen = set()
+
+  def store(data: bytes, rel_path: Path) -> Dict[str, Any]:
+    if pack is not None:
+      offset = pack.tell()
+      pack.write(data)
+      return {'offset': offset, 'size': len(data)}
+
+    full_path = src / rel_path
+    if not full_path.exists():
+      full_path.parent.mkdir(parents=True, exist_ok=True)
+      full_path.write_bytes(data)
+
+    return {'path': rel_path.as_posix(), 'size': len(data)}
+
+  try:
+    paths = [path for path in sorted(src.rglob('*')) if path.is_file() and RENDITIONS_DIR not in path.parts]
+
+    # images are quality scored in batches, so bad ones never make it into the library
+    for batch_start in range(0, len(paths), QUALITY_BATCH_SIZE):
+      batch = []
+      for path in paths[batch_start:batch_start + QUALITY_BATCH_SIZE]:
+        data = path.read_bytes()
+        img_type = filetype.guess(data)
+        if img_type is None or img_type.extension not in IMG_EXTENSIONS:
+          continue
+
+        digest = hash_bytes(data)
+        if digest in seen:
+          continue
+
+        seen.add(digest)
+        batch.append((path, data, digest, img_type.extension))
+
+      scores = score_batch([data for _, data, _, _ in batch]) if QUALITY_PREFILTER_ENABLED else [None] * len(batch)
+      for (path, data, digest, extension), quality in zip(batch, scores):
+        if quality is not None and not quality.passed:
+          log.warning(f'Skipping {path.name}: {quality}')
+          continue
+
+        with Image.open(path) as img:
+          width, height = img.size
+
+        entry: Dict[str, Any] = {
+          'hash': digest,
+          'width': width,
+          'height': height,
+          'format': extension,
+          'renditions': {},
+          **store(data, path.relative_to(src)),
+        }
+
+        for profile in profiles:
+          rendition = SourceImage(data, max_size_mb, profile)
+          rendition_path = Path(RENDITIONS_DIR) / f'{digest}.{profile}{rendition.path.suffix}'
+          entry['renditions'][rendition_key(profile, max_size_mb)] = {
+            'format': rendition.format,
+            **store(rendition.read(), rendition_path),
+          }
+          rendition.cleanup()
+
+        images.append(entry)
+        log.info(f'Indexed {path.name} ({width}x{height})')
+
+    index = json.dumps({'version': 1, 'images': images}).encode('utf-8')
+    if pack is not None:
+      index_offset = pack.tell()
+      pack.write(index)
+      pack.write(PACK_FOOTER.pack(index_offset, PACK_MAGIC))
+    else:
+      (src / INDEX_FILE).write_bytes(index)
+  finally:
+    if pack is not None:
+      pack.close()
+
+  log.success(f'Built library with {len(images)} images: {output or src / INDEX_FILE}')
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3 or sys.argv[1] != 'build':
+    print('Usage: python -m sources.library build <image directory> [output pack file]')
+    sys.exit(1)
+
+  build(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
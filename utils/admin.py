@@ -0,0 +1,238 @@
+import asyncio
+import hmac
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Literal, TypedDict
+
+from aiohttp import web
+
+from sources import ImageSource
+from utils.circuit import circuits
+from utils.clock import get_clock
+from utils.config import cfg
+from utils.constants import ADMIN_RUN_HISTORY
+from utils.job import PostJob
+from utils.logger import Logger
+from utils.watchdog import LoopMonitor
+
+log = Logger("Admin")
+
+# prepared: the jobs are ready & waiting for the posting time
+Phase = Literal['starting', 'waiting', 'preparing', 'prepared', 'posting', 'stopped']
+
+# task name prefixes for work that's talking to the apis
+TASK_PREFIXES = ('prepare:', 'twitter:', 'tumblr:', 'bluesky:')
+
+class RunTiming(TypedDict):
+  post_time: str
+  triggered: bool
+  jobs: int
+  prepare_seconds: float
+  post_seconds: float
+  # how long after the posting time the posts started going out
+  lateness: float
+
+
+# what the posting loop is currently doing, so it can be looked at & nudged from the admin server
+class PipelineState:
+  phase: Phase
+  next_run: datetime | None
+  jobs: List[PostJob]
+  runs: Deque[RunTiming]
+  draining: bool
+  wake: asyncio.Event
+
+  def __init__(self):
+    self.phase = 'starting'
+    self.next_run = None
+    self.jobs = []
+    self.runs = deque(maxlen=ADMIN_RUN_HISTORY)
+    self.draining = False
+    self.wake = asyncio.Event()
+
+  # sleeps until the given time, returning True early if a run was triggered (or a drain requested)
+  async def sleep_until(self, when: datetime) -> bool:
+    sleep = asyncio.ensure_future(get_clock().sleep_until(when))
+    wake = asyncio.ensure_future(self.wake.wait())
+
+    try:
+      await asyncio.wait({sleep, wake}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+      for task in (sleep, wake):
+        task.cancel()
+
+    triggered = self.wake.is_set()
+    self.wake.clear()
+    return triggered
+
+  def trigger(self):
+    self.wake.set()
+
+  # a trigger that arrives once a run has started shouldn't cause another run straight after it
+  def start_run(self):
+    self.phase = 'preparing'
+    self.wake.clear()
+
+  def drain(self):
+    self.draining = True
+    self.wake.set()
+
+  def add_run(self, post_time: datetime, triggered: bool, jobs: int, started_at: float, posted_at: float, finished_at: float):
+    self.runs.append(RunTiming(
+      post_time=post_time.isoformat(),
+      triggered=triggered,
+      jobs=jobs,
+      prepare_seconds=posted_at - started_at,
+      post_seconds=finished_at - posted_at,
+      lateness=posted_at - post_time.timestamp(),
+    ))
+
+
+pipeline = PipelineState()
+
+
+def describe_job(job: PostJob) -> Dict[str, Any]:
+  return {
+    'id': job.id,
+    'source': job.source_cfg['key'],
+    'post_time': job.post_time.isoformat(),
+    'images': [
+      { 'url': url, 'format': img.format, 'size': len(img.read()), 'width': img.width, 'height': img.height }
+      for img, url in zip(job.images, job.img_urls)
+    ],
+    # platforms that have already uploaded the media ahead of time
+    'uploaded': sorted(job.media),
+  }
+
+
+# a small http server for orchestrators & humans: liveness & readiness checks, json views of the
+# pipeline, and authenticated endpoints to trigger a run or drain the bot
+class AdminServer:
+  monitor: LoopMonitor
+  sources: List[ImageSource]
+  started_at: float
+  _runner: web.AppRunner | None
+
+  def __init__(self, monitor: LoopMonitor, sources: List[ImageSource]):
+    self.monitor = monitor
+    self.sources = sources
+    self.started_at = get_clock().time()
+    self._runner = None
+
+  async def start(self):
+    app = web.Application(middlewares=[self.auth])
+    app.add_routes([
+      web.get('/healthz', self.healthz),
+      web.get('/readyz', self.readyz),
+      web.get('/jobs', self.jobs),
+      web.get('/runs', self.runs),
+      web.get('/platforms', self.platforms),
+      web.post('/run', self.run),
+      web.post('/drain', self.drain),
+    ])
+
+    admin_cfg = cfg.cfg['admin']
+    self._runner = web.AppRunner(app, access_log=None)
+    await self._runner.setup()
+    await web.TCPSite(self._runner, admin_cfg['host'], admin_cfg['port']).start()
+
+    log.success(f'Admin server listening on http://{admin_cfg["host"]}:{admin_cfg["port"]}')
+
+  async def stop(self):
+    if self._runner is not None:
+      await self._runner.cleanup()
+      self._runner = None
+
+  # only the read-only views are open, anything that changes state needs the token
+  @web.middleware
+  async def auth(self, request: web.Request, handler):
+    if request.method == 'GET':
+      return await handler(request)
+
+    token = cfg.cfg['admin']['token']
+    if not token:
+      return web.json_response({ 'error': 'no admin token is configured' }, status=403)
+
+    given = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(given.encode(), token.encode()):
+      return web.json_response({ 'error': 'unauthorized' }, status=401)
+
+    return await handler(request)
+
+  # the process is alive as long as the loop is answering requests & the posting loop hasn't died
+  async def healthz(self, _: web.Request) -> web.Response:
+    alive = pipeline.phase != 'stopped'
+    return web.json_response({
+      'status': 'ok' if alive else 'stopped',
+      'uptime': get_clock().time() - self.started_at,
+      'loop_lag': self.monitor.lag,
+    }, status=200 if alive else 503)
+
+  # ready to be relied on for the next run: started up, not draining, the loop isn't stalling
+  # & at least one enabled platform isn't being skipped by its circuit breaker
+  async def readyz(self, _: web.Request) -> web.Response:
+    checks = {
+      'started': pipeline.phase not in ('starting', 'stopped'),
+      'not_draining': not pipeline.draining,
+      'loop_responsive': self.monitor.lag < self.monitor.threshold,
+      'platforms_available': any(
+        not circuits.get(platform.capitalize(), cfg.cfg[key]).is_open()
+        for key in ('cat', 'dog') if cfg.cfg[key]['enabled']
+        for platform in ('twitter', 'tumblr', 'bluesky') if cfg.cfg[key][platform]['enabled']
+      ),
+    }
+
+    ready = all(checks.values())
+    return web.json_response({ 'ready': ready, 'checks': checks }, status=200 if ready else 503)
+
+  async def jobs(self, _: web.Request) -> web.Response:
+    in_flight = [
+      task.get_name()
+      for task in asyncio.all_tasks()
+      if task.get_name().startswith(TASK_PREFIXES) and not task.done()
+    ]
+
+    return web.json_response({
+      'phase': pipeline.phase,
+      'draining': pipeline.draining,
+      'next_run': pipeline.next_run.isoformat() if pipeline.next_run is not None else None,
+      'jobs': [describe_job(job) for job in pipeline.jobs],
+      'in_flight': sorted(in_flight),
+    })
+
+  async def runs(self, _: web.Request) -> web.Response:
+    return web.json_response({ 'runs': list(pipeline.runs) })
+
+  async def platforms(self, _: web.Request) -> web.Response:
+    return web.json_response({
+      'circuits': { key: breaker.data for key, breaker in circuits.breakers.items() },
+      'sources': {
+        source.name: [
+          { 'url': endpoint.url, 'latency': endpoint.latency, 'error_rate': endpoint.error_rate, 'in_flight': endpoint.in_flight, 'samples': endpoint.samples }
+          for endpoint in source.endpoints
+        ]
+        for source in self.sources
+      },
+      'loop': {
+        'lag': self.monitor.lag,
+        'max_lag': self.monitor.max_lag,
+        'stalls': [{ 'at': stall['at'], 'duration': stall['duration'], 'task': stall['task'] } for stall in self.monitor.stalls],
+      },
+    })
+
+  async def run(self, _: web.Request) -> web.Response:
+    if pipeline.draining:
+      return web.json_response({ 'error': 'draining' }, status=409)
+
+    # a run is already underway
+    if pipeline.phase != 'waiting':
+      return web.json_response({ 'error': f'a run is already {pipeline.phase}', 'phase': pipeline.phase }, status=409)
+
+    log.info('Run triggered through the admin server.')
+    pipeline.trigger()
+    return web.json_response({ 'triggered': True, 'phase': pipeline.phase }, status=202)
+
+  async def drain(self, _: web.Request) -> web.Response:
+    log.info('Draining through the admin server, exiting after the current run.')
+    pipeline.drain()
+    return web.json_response({ 'draining': True, 'phase': pipeline.phase }, status=202)
@@ -0,0 +1,137 @@
+from typing import Dict, List, Set, Tuple
+
+from discord import Embed
+import requests
+
+from utils.clock import get_clock
+from utils.config import AnimalConfig, get_account_name
+from utils.constants import ALERT_DIGEST_WINDOW_SECONDS
+from utils.logger import Logger
+from utils.webhook import send_to_webhook
+
+log = Logger("Alerts")
+
+# (platform, exception type, status)
+Fingerprint = Tuple[str, str, str]
+
+class AlertState:
+  description: str
+  first_sent: float
+  suppressed: int
+  accounts: Set[str]
+  urls: List[str]
+
+  def __init__(self, description: str, url: str, account: str):
+    self.description = description
+    self.first_sent = get_clock().monotonic()
+    self.suppressed = 0
+    self.accounts = {account}
+    self.urls = [url] if url else []
+
+  def add(self, url: str, account: str):
+    self.suppressed += 1
+    self.accounts.add(account)
+    if url and url not in self.urls:
+      self.urls.append(url)
+
+
+_active: Dict[Fingerprint, AlertState] = {}
+
+def get_status(exception: Exception | str | None, response: requests.Response | dict | None) -> str:
+  # the response the error came with, if the exception has one
+  res = getattr(exception, 'response', None) or response
+  if isinstance(res, dict):
+    return str(res.get('meta', {}).get('status') or res.get('status') or '')
+
+  return str(getattr(res, 'status_code', None) or getattr(res, 'status', None) or '')
+
+
+# sends an error alert, unless the same error was already alerted recently,
+# in which case it's counted towards the next digest instead
+async def alert(
+  url: str,
+  platform: str,
+  source_cfg: AnimalConfig,
+  description: str,
+  exception: Exception | str | None = None,
+  response: requests.Response | dict | None = None,
+):
+  account = get_account_name(source_cfg, platform)
+  exc_type = type(exception).__name__ if isinstance(exception, Exception) else ''
+  fingerprint: Fingerprint = (platform, exc_type or description, get_status(exception, response))
+
+  state = _active.get(fingerprint)
+  if state is not None:
+    state.add(url, account)
+    log.info(f'Suppressed repeated alert for {platform} ({description}) - {state.suppressed} so far this window.')
+    return
+
+  _active[fingerprint] = AlertState(description, url, account)
+
+  embed = Embed(
+    title='Error',
+    description=description,
+  )
+  embed.set_footer(text=f'{platform} - {account}')
+  await send_to_webhook(
+    url=url,
+    content='@everyone',
+    embed=embed,
+    exception=exception,
+    response=response
+  )
+
+
+# sends a recovery notice for any active alerts on a platform once an account is working again
+async def resolve(platform: str, source_cfg: AnimalConfig):
+  account = get_account_name(source_cfg, platform)
+
+  for fingerprint, state in list(_active.items()):
+    if fingerprint[0] != platform or account not in state.accounts:
+      continue
+
+    state.accounts.discard(account)
+    if state.accounts:
+      continue
+
+    del _active[fingerprint]
+
+    embed = Embed(
+      title='Recovered',
+      description=f'{platform} is working again after: {state.description}',
+    )
+    if state.suppressed:
+      embed.add_field(name='Suppressed alerts', value=str(state.suppressed))
+
+    for url in state.urls:
+      await send_to_webhook(url=url, embed=embed)
+
+
+# sends a digest for every alert whose window has passed, then starts a new window for it
+async def flush_alerts():
+  now = get_clock().monotonic()
+
+  for fingerprint, state in list(_active.items()):
+    if now - state.first_sent < ALERT_DIGEST_WINDOW_SECONDS:
+      continue
+
+    platform, exc_type, status = fingerprint
+    if state.suppressed == 0:
+      # nothing happened since the alert, keep tracking it so a recovery notice is still sent
+      state.first_sent = now
+      continue
+
+    embed = Embed(
+      title='Error digest',
+      description=f'{platform}: {state.description}',
+    )
+    embed.add_field(name='Repeats', value=str(state.suppressed))
+    embed.add_field(name='Affected accounts', value='\n'.join(sorted(state.accounts)), inline=False)
+    if exc_type != state.description:
+      embed.add_field(name='Error', value=f'{exc_type} {status}'.strip())
+
+    for url in state.urls:
+      await send_to_webhook(url=url, embed=embed)
+
+    state.first_sent = now
+    state.suppressed = 0
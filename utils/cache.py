@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple, TypedDict
+
+from utils.constants import CACHE_DIR, MAX_CACHE_SIZE_MB
+from utils.logger import Logger
+
+
+class CacheIndex(TypedDict):
+  urls: Dict[str, str]
+  renditions: Dict[str, str]
+
+
+def hash_bytes(data: bytes) -> str:
+  return hashlib.sha256(data).hexdigest()
+
+
+class ImageCache:
+  path: Path
+  objects_dir: Path
+  index_path: Path
+  max_size: int
+  # running total of the objects' size, so writes don't have to rescan the cache
+  size: int
+  index: CacheIndex
+  log: Logger
+
+  def __init__(self, path: str | Path, max_size_mb: int):
+    self.max_size = max_size_mb * 1000 * 1000
+    self.log = Logger("Cache")
+    self._lock = threading.Lock()
+
+    self.open(path)
+
+  # (re)points the cache at a directory, the simulation keeps its images out of the real cache this way
+  def open(self, path: str | Path):
+    with self._lock:
+      self.path = Path(path)
+      self.objects_dir = self.path / 'objects'
+      self.index_path = self.path / 'index.json'
+
+      self.objects_dir.mkdir(parents=True, exist_ok=True)
+      self.load()
+      self.size = sum(size for _, size, _ in self.scan())
+
+  def load(self):
+    self.index = CacheIndex(urls={}, renditions={})
+    if not self.index_path.exists():
+      return
+
+    try:
+      with open(self.index_path, 'r', encoding='utf-8') as f:
+        loaded = json.load(f)
+
+      self.index['urls'] = loaded.get('urls', {})
+      self.index['renditions'] = loaded.get('renditions', {})
+    except Exception as e:
+      self.log.warning(f'Failed to load cache index, starting fresh: {e!r}')
+
+  def save(self):
+    # write to a temp file first so a crash mid-write can't corrupt the index
+    tmp_path = self.index_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      json.dump(self.index, f)
+
+    os.replace(tmp_path, self.index_path)
+
+  def object_path(self, digest: str) -> Path:
+    return self.objects_dir / digest[:2] / digest
+
+  # ---- raw objects (content addressed) ---- #
+  # every caller needs the whole image as bytes, so this is a plain read (mapping it would only add a copy)
+  def read(self, digest: str) -> bytes | None:
+    path = self.object_path(digest)
+
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+    except FileNotFoundError:
+      return None
+
+    if len(data) == 0:
+      return None
+
+    # bump the access time so eviction treats this as recently used
+    os.utime(path)
+    return data
+
+  def write(self, data: bytes) -> str:
+    digest = hash_bytes(data)
+    path = self.object_path(digest)
+
+    if path.exists():
+      os.utime(path)
+      return digest
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+      f.write(data)
+
+    os.replace(tmp_path, path)
+    self.size += len(data)
+    if self.size > self.max_size:
+      self.evict()
+
+    return digest
+
+  # ---- lookups ---- #
+  def get_url(self, url: str) -> bytes | None:
+    with self._lock:
+      digest = self.index['urls'].get(url)
+      if digest is None:
+        return None
+
+      return self.read(digest)
+
+  def put_url(self, url: str, data: bytes) -> str:
+    with self._lock:
+      digest = self.write(data)
+      self.index['urls'][url] = digest
+      self.save()
+
+      return digest
+
+  def get_rendition(self, key: str) -> bytes | None:
+    with self._lock:
+      digest = self.index['renditions'].get(key)
+      if digest is None:
+        return None
+
+      return self.read(digest)
+
+  def put_rendition(self, key: str, data: bytes) -> str:
+    with self._lock:
+      digest = self.write(data)
+      self.index['renditions'][key] = digest
+      self.save()
+
+      return digest
+
+  # ---- eviction ---- #
+  # (last used, size, path) of every object
+  def scan(self) -> List[Tuple[float, int, Path]]:
+    entries = []
+    for path in self.objects_dir.glob('*/*'):
+      if path.suffix == '.tmp':
+        continue
+
+      try:
+        stat = path.stat()
+      except FileNotFoundError:
+        continue
+
+      entries.append((stat.st_mtime, stat.st_size, path))
+
+    return entries
+
+  # only scans the cache once the running total says it's over the limit
+  def evict(self):
+    entries = self.scan()
+    total_size = sum(size for _, size, _ in entries)
+    self.size = total_size
+
+    if total_size <= self.max_size:
+      return
+
+    # least recently used first
+    entries.sort(key=lambda entry: entry[0])
+
+    removed = set()
+    for _, size, path in entries:
+      if total_size <= self.max_size:
+        break
+
+      path.unlink(missing_ok=True)
+      removed.add(path.name)
+      total_size -= size
+
+    self.size = total_size
+
+    # drop index entries pointing at evicted objects
+    for table in (self.index['urls'], self.index['renditions']):
+      for key in [key for key, digest in table.items() if digest in removed]:
+        del table[key]
+
+    self.log.info(f'Evicted {len(removed)} object(s) from the image cache.')
+
+
+image_cache = ImageCache(CACHE_DIR, MAX_CACHE_SIZE_MB)
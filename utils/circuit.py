@@ -0,0 +1,138 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Literal, TypedDict
+
+from utils.clock import get_clock
+from utils.config import AnimalConfig, get_account_name
+from utils.constants import CIRCUIT_COOLDOWN_SECONDS, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_MAX_COOLDOWN_SECONDS, DATA_DIR
+from utils.logger import Logger
+
+CircuitState = Literal['closed', 'open', 'half_open']
+
+class CircuitData(TypedDict):
+  state: CircuitState
+  failures: int
+  opened_at: float
+  cooldown: float
+
+
+class CircuitBreaker:
+  key: str
+  data: CircuitData
+  probing: bool
+
+  def __init__(self, store: 'CircuitStore', key: str, data: CircuitData | None = None):
+    self.store = store
+    self.key = key
+    self.data = data or CircuitData(state='closed', failures=0, opened_at=0, cooldown=CIRCUIT_COOLDOWN_SECONDS)
+    self.probing = False
+
+  @property
+  def state(self) -> CircuitState:
+    return self.data['state']
+
+  # whether calls are currently being skipped, without claiming the half-open probe
+  def is_open(self) -> bool:
+    return self.state == 'open' and get_clock().time() - self.data['opened_at'] < self.data['cooldown']
+
+  # whether a call should be attempted. once the cooldown has passed an open circuit lets a single probe through
+  def allow(self) -> bool:
+    if self.state == 'closed':
+      return True
+
+    if self.state == 'open':
+      if get_clock().time() - self.data['opened_at'] < self.data['cooldown']:
+        return False
+
+      self.data['state'] = 'half_open'
+      self.store.log.info(f'Circuit for {self.key} is half-open, probing.')
+
+    # half-open: only one probe at a time
+    if self.probing:
+      return False
+
+    self.probing = True
+    return True
+
+  def record_success(self):
+    if self.state != 'closed':
+      self.store.log.success(f'Circuit for {self.key} is closed again.')
+
+    self.probing = False
+    self.data = CircuitData(state='closed', failures=0, opened_at=0, cooldown=CIRCUIT_COOLDOWN_SECONDS)
+    self.store.save()
+
+  def record_failure(self):
+    self.data['failures'] += 1
+
+    if self.state == 'half_open':
+      # the probe failed, so back off for longer before the next one
+      self.data['cooldown'] = min(self.data['cooldown'] * 2, CIRCUIT_MAX_COOLDOWN_SECONDS)
+      self.open()
+    elif self.state == 'closed' and self.data['failures'] >= CIRCUIT_FAILURE_THRESHOLD:
+      self.open()
+
+    self.probing = False
+    self.store.save()
+
+  def record(self, success: bool):
+    if success:
+      self.record_success()
+    else:
+      self.record_failure()
+
+  def open(self):
+    self.data['state'] = 'open'
+    self.data['opened_at'] = get_clock().time()
+    self.store.log.warning(f'Circuit for {self.key} is open, skipping it for {int(self.data["cooldown"])}s.')
+
+
+class CircuitStore:
+  path: Path
+  breakers: Dict[str, CircuitBreaker]
+  log: Logger
+
+  def __init__(self, path: str | Path):
+    self.path = Path(path)
+    self.breakers = {}
+    self.log = Logger("Circuit")
+
+    self.load()
+
+  def load(self):
+    if not self.path.exists():
+      return
+
+    try:
+      with open(self.path, 'r', encoding='utf-8') as f:
+        loaded: Dict[str, CircuitData] = json.load(f)
+    except Exception as e:
+      self.log.warning(f'Failed to load circuit states, starting fresh: {e!r}')
+      return
+
+    for key, data in loaded.items():
+      # a probe can't still be in flight after a restart
+      if data.get('state') == 'half_open':
+        data['state'] = 'open'
+
+      self.breakers[key] = CircuitBreaker(self, key, data)
+
+  def save(self):
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = self.path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      json.dump({key: breaker.data for key, breaker in self.breakers.items()}, f, indent=2)
+
+    os.replace(tmp_path, self.path)
+
+  def get(self, platform: str, source_cfg: AnimalConfig) -> CircuitBreaker:
+    key = f'{platform}:{get_account_name(source_cfg, platform)}'
+    if key not in self.breakers:
+      self.breakers[key] = CircuitBreaker(self, key)
+
+    return self.breakers[key]
+
+
+circuits = CircuitStore(Path(DATA_DIR) / 'circuits.json')
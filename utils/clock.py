@@ -0,0 +1,120 @@
+import asyncio
+import selectors
+import time
+from datetime import datetime
+from typing import Any, Callable
+
+# where the current time comes from. everything schedule related should go through get_clock(),
+# so the posting loop can be run against a simulated clock
+class Clock:
+  # local time with its utc offset, so adding to it is in real elapsed time, even across dst changes
+  def now(self) -> datetime:
+    return datetime.now().astimezone()
+
+  def time(self) -> float:
+    return time.time()
+
+  def monotonic(self) -> float:
+    return time.monotonic()
+
+  # sleeps until a point in time, going by the seconds left rather than wall clock differences
+  async def sleep_until(self, when: datetime):
+    await asyncio.sleep(max(when.timestamp() - self.time(), 0))
+
+
+# a clock that only moves forward when the event loop it drives has nothing to do, at which point
+# it skips straight to the next timer, so hours of sleeping take no real time at all
+class VirtualClock(Clock):
+  epoch: float
+  elapsed: float
+  # how many calls are running in threads, which still take real time to finish
+  busy: int
+
+  def __init__(self, start: datetime):
+    self.epoch = start.timestamp()
+    self.elapsed = 0
+    self.busy = 0
+
+  def now(self) -> datetime:
+    return datetime.fromtimestamp(self.time()).astimezone()
+
+  def time(self) -> float:
+    return self.epoch + self.elapsed
+
+  def monotonic(self) -> float:
+    return self.elapsed
+
+  def advance(self, seconds: float):
+    self.elapsed += max(seconds, 0)
+
+
+class VirtualSelector(selectors.BaseSelector):
+  clock: VirtualClock
+  selector: selectors.BaseSelector
+
+  def __init__(self, clock: VirtualClock):
+    self.clock = clock
+    self.selector = selectors.DefaultSelector()
+
+  def register(self, fileobj, events, data=None) -> selectors.SelectorKey:
+    return self.selector.register(fileobj, events, data)
+
+  def unregister(self, fileobj) -> selectors.SelectorKey:
+    return self.selector.unregister(fileobj)
+
+  def modify(self, fileobj, events, data=None) -> selectors.SelectorKey:
+    return self.selector.modify(fileobj, events, data)
+
+  def get_map(self):
+    return self.selector.get_map()
+
+  def close(self):
+    self.selector.close()
+
+  def select(self, timeout: float | None = None):
+    # waiting on a thread (or on nothing at all), so wait in real time & count it towards virtual time
+    if self.clock.busy > 0 or timeout is None:
+      start = time.monotonic()
+      events = self.selector.select(timeout)
+      self.clock.advance(time.monotonic() - start)
+      return events
+
+    # otherwise only poll, then jump to the next timer
+    events = self.selector.select(0)
+    if not events:
+      self.clock.advance(timeout)
+
+    return events
+
+
+# an event loop whose time is a virtual clock, so asyncio.sleep & timeouts all run on simulated time
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+  clock: VirtualClock
+
+  def __init__(self, clock: VirtualClock):
+    super().__init__(VirtualSelector(clock))
+    self.clock = clock
+
+  def time(self) -> float:
+    return self.clock.monotonic()
+
+  def run_in_executor(self, executor: Any, func: Callable[..., Any], *args: Any) -> asyncio.Future:
+    future = super().run_in_executor(executor, func, *args)
+
+    self.clock.busy += 1
+    future.add_done_callback(self._release)
+    return future
+
+  def _release(self, _: asyncio.Future):
+    self.clock.busy -= 1
+
+
+_clock: Clock = Clock()
+
+def get_clock() -> Clock:
+  return _clock
+
+
+def set_clock(clock: Clock):
+  global _clock
+  _clock = clock
@@ -5,7 +5,7 @@ import json
 import os
 from typing import TypedDict, List, Literal
 
-from utils.constants import CAT_TAGS, DOG_TAGS
+from utils.constants import CAT_API_URL, CAT_TAGS, DOG_API_URL, DOG_TAGS, MAX_ALBUM_SIZES
 from utils.logger import Logger
 
 AnimalType = Literal['cat', 'dog']
@@ -13,6 +13,7 @@ AnimalType = Literal['cat', 'dog']
 class ConfigType(TypedDict):
   cat: AnimalConfig
   dog: AnimalConfig
+  admin: AdminConfig
 
 
 class AnimalConfig(TypedDict):
@@ -20,14 +21,25 @@ class AnimalConfig(TypedDict):
   key: AnimalType
   name: str
   api_key: str
+  endpoints: List[str]
+  library: LibraryConfig
   twitter: TwitterConfig
   tumblr: TumblrConfig
   bluesky: BlueskyConfig
   webhooks: DiscordWebhooks
 
 
+class LibraryConfig(TypedDict):
+  # a library directory or pack file built with `python -m sources.library build`
+  path: str
+  # "fallback" to use it when the api is down, or "primary" to only post from the library
+  mode: Literal['fallback', 'primary']
+
+
 class TwitterConfig(TypedDict):
   enabled: bool
+  # how many images to post at once
+  album_size: int
   consumer_key: str
   consumer_secret: str
   access_token: str
@@ -36,6 +48,8 @@ class TwitterConfig(TypedDict):
 
 class TumblrConfig(TypedDict):
   enabled: bool
+  # how many images to post at once
+  album_size: int
   tags: List[str]
   blogname: str
   consumer_key: str
@@ -46,6 +60,8 @@ class TumblrConfig(TypedDict):
 
 class BlueskyConfig(TypedDict):
   enabled: bool
+  # how many images to post at once
+  album_size: int
   username: str
   app_password: str
 
@@ -58,6 +74,27 @@ class DiscordWebhooks(TypedDict):
   post_notification: str
 
 
+class AdminConfig(TypedDict):
+  enabled: bool
+  host: str
+  port: int
+  # bearer token for triggering runs & draining, those endpoints are disabled without one
+  token: str
+
+
+# a readable name for the account a platform posts as, for logs & alerts
+def get_account_name(source_cfg: AnimalConfig, platform: str) -> str:
+  account_keys = {'twitter': 'access_token', 'tumblr': 'blogname', 'bluesky': 'username'}
+  key = account_keys.get(platform.lower())
+  account = source_cfg[platform.lower()][key] if key else '' # type: ignore
+
+  # never include credentials, the access token is prefixed with the user id
+  if key == 'access_token':
+    account = account.split('-')[0]
+
+  return f'{source_cfg["key"]} ({account})' if account else source_cfg['key']
+
+
 class Config:
   path: str
   cfg: ConfigType
@@ -81,17 +118,21 @@ class Config:
       loaded_cfg = {}
 
     cat_config = loaded_cfg.get("cat", {})
+    cat_library = cat_config.get("library", {})
     cat_twitter = cat_config.get("twitter", {})
     cat_tumblr = cat_config.get("tumblr", {})
     cat_bluesky = cat_config.get("bluesky", {})
     cat_discord_webhooks = cat_config.get("webhooks")
 
     dog_config = loaded_cfg.get("dog", {})
+    dog_library = dog_config.get("library", {})
     dog_twitter = dog_config.get("twitter", {})
     dog_tumblr = dog_config.get("tumblr", {})
     dog_bluesky = dog_config.get("bluesky", {})
     dog_discord_webhooks = dog_config.get("webhooks")
 
+    admin_config = loaded_cfg.get("admin", {})
+
     old_cfg = copy.deepcopy(self.cfg) if hasattr(self, 'cfg') else None
 
     self.cfg = ConfigType(
@@ -100,8 +141,14 @@ class Config:
         key="cat",
         name="TheCatAPI",
         api_key=cat_config.get("api_key", ""),
+        endpoints=cat_config.get("endpoints", [CAT_API_URL]),
+        library=LibraryConfig(
+          path=cat_library.get("path", ""),
+          mode=cat_library.get("mode", "fallback")
+        ),
         twitter=TwitterConfig(
           enabled=cat_twitter.get("enabled", False),
+          album_size=cat_twitter.get("album_size", 1),
           consumer_key=cat_twitter.get("consumer_key", ""),
           consumer_secret=cat_twitter.get("consumer_secret", ""),
           access_token=cat_twitter.get("access_token", ""),
@@ -109,6 +156,7 @@ class Config:
         ),
         tumblr=TumblrConfig(
           enabled=cat_tumblr.get("enabled", False),
+          album_size=cat_tumblr.get("album_size", 1),
           tags=cat_tumblr.get("tags", list(CAT_TAGS)),
           blogname=cat_tumblr.get("blogname", ""),
           consumer_key=cat_tumblr.get("consumer_key", ""),
@@ -118,6 +166,7 @@ class Config:
         ),
         bluesky=BlueskyConfig(
           enabled=cat_bluesky.get("enabled", False),
+          album_size=cat_bluesky.get("album_size", 1),
           username=cat_bluesky.get("username", ""),
           app_password=cat_bluesky.get("app_password", "")
         ),
@@ -134,8 +183,14 @@ class Config:
         key="dog",
         name="TheDogAPI",
         api_key=dog_config.get("api_key", ""),
+        endpoints=dog_config.get("endpoints", [DOG_API_URL]),
+        library=LibraryConfig(
+          path=dog_library.get("path", ""),
+          mode=dog_library.get("mode", "fallback")
+        ),
         twitter=TwitterConfig(
           enabled=dog_twitter.get("enabled", False),
+          album_size=dog_twitter.get("album_size", 1),
           consumer_key=dog_twitter.get("consumer_key", ""),
           consumer_secret=dog_twitter.get("consumer_secret", ""),
           access_token=dog_twitter.get("access_token", ""),
@@ -143,6 +198,7 @@ class Config:
         ),
         tumblr=TumblrConfig(
           enabled=dog_tumblr.get("enabled", False),
+          album_size=dog_tumblr.get("album_size", 1),
           tags=dog_tumblr.get("tags", list(DOG_TAGS)),
           blogname=dog_tumblr.get("blogname", ""),
           consumer_key=dog_tumblr.get("consumer_key", ""),
@@ -152,6 +208,7 @@ class Config:
         ),
         bluesky=BlueskyConfig(
           enabled=dog_bluesky.get("enabled", False),
+          album_size=dog_bluesky.get("album_size", 1),
           username=dog_bluesky.get("username", ""),
           app_password=dog_bluesky.get("app_password", "")
         ),
@@ -162,6 +219,12 @@ class Config:
           misc=dog_discord_webhooks.get("misc", ""),
           post_notification=dog_discord_webhooks.get("post_notification", "")
         )
+      ),
+      admin=AdminConfig(
+        enabled=admin_config.get("enabled", False),
+        host=admin_config.get("host", "127.0.0.1"),
+        port=admin_config.get("port", 8787),
+        token=admin_config.get("token", "")
       )
     )
 
@@ -174,7 +237,7 @@ class Config:
     # validate cfg entries
     # if a social media platform is enabled, ensure all keys are set
     has_found_enabled_source = False
-    for source in self.cfg:
+    for source in ('cat', 'dog'):
       source_cfg: AnimalConfig = self.cfg[source]
 
       # skip if not enabled
@@ -183,11 +246,31 @@ class Config:
 
       has_found_enabled_source = True
 
-      # needs an api key to function lol
-      if not source_cfg['api_key']:
+      # needs an api key to function lol (unless we're only posting from a local library)
+      uses_api = not (source_cfg['library']['path'] and source_cfg['library']['mode'] == 'primary')
+      if uses_api and not source_cfg['api_key']:
         self.log.error(f'API key is not set for source "{source}" ("{source_cfg["name"]}").')
         exit_needed = True
 
+      if len(source_cfg['endpoints']) == 0:
+        self.log.error(f'No endpoints are set for source "{source}" ("{source_cfg["name"]}").')
+        exit_needed = True
+
+      library_path = source_cfg['library']['path']
+      if library_path and not os.path.exists(library_path):
+        self.log.error(f'Library "{library_path}" for source "{source}" ("{source_cfg["name"]}") does not exist.')
+        exit_needed = True
+
+      if source_cfg['library']['mode'] not in ('fallback', 'primary'):
+        self.log.error(f'Library mode for source "{source}" ("{source_cfg["name"]}") must be "fallback" or "primary".')
+        exit_needed = True
+
+      for platform, max_album_size in MAX_ALBUM_SIZES.items():
+        album_size = source_cfg[platform]['album_size']
+        if not isinstance(album_size, int) or not 1 <= album_size <= max_album_size:
+          self.log.error(f'Album size for {platform} in source "{source}" ("{source_cfg["name"]}") must be between 1 and {max_album_size}.')
+          exit_needed = True
+
       # twitter
       if source_cfg['twitter']['enabled']:
         twitter_keys = ['consumer_key', 'consumer_secret', 'access_token', 'access_token_secret']
@@ -254,6 +337,16 @@ class Config:
       self.log.error('No enabled sources found. Please enable at least one source.')
       exit_needed = True
 
+    # admin server
+    admin_cfg = self.cfg['admin']
+    if admin_cfg['enabled']:
+      if not isinstance(admin_cfg['port'], int) or not 0 < admin_cfg['port'] < 65536:
+        self.log.error(f'Admin server port {admin_cfg["port"]} is invalid.')
+        exit_needed = True
+
+      if not admin_cfg['token']:
+        self.log.warning('No admin token is set, so runs can\'t be triggered & the bot can\'t be drained through the admin server.')
+
     if exit_needed and should_exit:
       os._exit(1)
 
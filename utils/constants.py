@@ -1,11 +1,100 @@
-from typing import Dict, Final
+from typing import Dict, Final, List
 
 # ---- Misc ---- #
 IMG_EXTENSIONS = ["jpg", "png", "jpeg", "webp"]
 
 MAX_IMG_SIZE_MB: Final[int] = 1
+# images with more pixels than this are rejected before decoding (decompression bomb protection)
+MAX_IMAGE_PIXELS: Final[int] = 50_000_000
 MAX_IMG_FETCH_RETRY: Final[int] = 3
 
+# how many images each platform allows in a single post
+MAX_ALBUM_SIZES: Final[Dict[str, int]] = {
+  "twitter": 4,
+  "tumblr": 10,
+  "bluesky": 4,
+}
+
+# which profile in utils/image.py ENCODER_PROFILES to encode images with ("fast", "balanced" or "small")
+ENCODER_PROFILE: Final[str] = 'balanced'
+
+# ---- Quality prefilter ---- #
+# images are scored on a small draft decode before any full resolution work
+QUALITY_PREFILTER_ENABLED: Final[bool] = True
+QUALITY_DRAFT_SIZE: Final[int] = 256
+QUALITY_MIN_DIMENSION: Final[int] = 300
+QUALITY_MIN_SHARPNESS: Final[float] = 15
+QUALITY_MIN_ENTROPY: Final[float] = 4
+# max fraction of the height/width taken up by uniform borders
+QUALITY_MAX_LETTERBOX: Final[float] = 0.3
+QUALITY_UNIFORM_STD: Final[float] = 4
+QUALITY_BATCH_SIZE: Final[int] = 64
+
+# ---- Source endpoints ---- #
+CAT_API_URL: Final[str] = 'https://api.thecatapi.com/v1/images/search?mime_types=jpg,png'
+DOG_API_URL: Final[str] = 'https://api.thedogapi.com/v1/images/search?mime_types=jpg,png'
+
+# weight given to each new sample in an endpoint's rolling latency & error rate
+ENDPOINT_EWMA_ALPHA: Final[float] = 0.3
+ENDPOINT_MAX_ERROR_RATE: Final[float] = 0.5
+ENDPOINT_DEGRADED_LATENCY_SECONDS: Final[float] = 10
+# scores only change when an endpoint is used, so a degraded source with a fallback is still tried this often
+ENDPOINT_PROBE_INTERVAL_SECONDS: Final[float] = 30 * 60
+
+# ---- Hedged image fetching ---- #
+# how long after the scheduled posting time we'll keep trying to fetch an image
+FETCH_DEADLINE_SECONDS: Final[int] = 90
+# a second fetch is started once the first has taken longer than this percentile of recent fetches
+HEDGE_LATENCY_PERCENTILE: Final[float] = 0.95
+HEDGE_LATENCY_WINDOW: Final[int] = 50
+HEDGE_DEFAULT_DELAY_SECONDS: Final[float] = 5
+HEDGE_MIN_DELAY_SECONDS: Final[float] = 1
+
+DATA_DIR: Final[str] = './data'
+
+# ---- Post history (report with python -m utils.history) ---- #
+HISTORY_REPORT_DAYS: Final[int] = 7
+HISTORY_REPORT_PERCENTILES: Final[List[float]] = [0.5, 0.9, 0.99]
+HISTORY_SLOWEST_PHASES: Final[int] = 10
+
+# ---- Simulation (run with --simulate HOURS) ---- #
+# median latency of each request to the stand-in, with a lognormal spread so there are slow outliers
+SIMULATION_SOURCE_LATENCY_SECONDS: Final[float] = 0.5
+SIMULATION_UPLOAD_LATENCY_SECONDS: Final[float] = 0.6
+SIMULATION_POST_LATENCY_SECONDS: Final[float] = 0.8
+SIMULATION_LATENCY_SPREAD: Final[float] = 0.6
+# chance of each request failing with a 503
+SIMULATION_SOURCE_FAILURE_RATE: Final[float] = 0.05
+SIMULATION_PLATFORM_FAILURE_RATE: Final[float] = 0.02
+# how many distinct images the stand-in apis pick from
+SIMULATION_IMAGES: Final[int] = 8
+
+# ---- Admin server (configured under "admin" in config.json) ---- #
+# how many recent runs the admin server keeps timings for
+ADMIN_RUN_HISTORY: Final[int] = 48
+
+# ---- Profiling (enable with --profile / --profile-every) ---- #
+PROFILE_DIR: Final[str] = './profiles'
+PROFILE_INTERVAL_SECONDS: Final[float] = 0.005
+# how many profiles to keep before the oldest are deleted
+PROFILE_KEEP: Final[int] = 24
+
+# ---- Event loop watchdog ---- #
+LOOP_MONITOR_INTERVAL_SECONDS: Final[float] = 0.1
+# how long the loop can be blocked before the blocking stack is captured
+LOOP_STALL_THRESHOLD_SECONDS: Final[float] = 0.5
+LOOP_STALL_HISTORY: Final[int] = 50
+
+# ---- Memory watchdog (allocation tracing is enabled with --trace-memory) ---- #
+MEMORY_RSS_THRESHOLD_MB: Final[int] = 512
+MEMORY_CHECK_INTERVAL_SECONDS: Final[int] = 60
+MEMORY_TRACE_FRAMES: Final[int] = 10
+MEMORY_REPORT_TOP: Final[int] = 15
+
+# ---- Image cache ---- #
+CACHE_DIR: Final[str] = './cache'
+MAX_CACHE_SIZE_MB: Final[int] = 512
+
 CAT_TAGS = [
   "cat",
   "cats",
@@ -53,7 +142,39 @@ DOG_TAGS = [
   "woof",
 ]
 
+# ---- Scheduling ---- #
+# how long before the posting time images are fetched & uploaded, so only the posts themselves happen on the hour
+PREP_LEAD_SECONDS: Final[int] = 120
+# how long before the posting time idle connections & sessions are refreshed, so the first request doesn't pay for a handshake
+WARMUP_LEAD_SECONDS: Final[int] = 20
+
+# ---- Twitter ---- #
+TWITTER_UPLOAD_CHUNK_SIZE: Final[int] = 256 * 1024
+TWITTER_UPLOAD_CONCURRENCY: Final[int] = 4
+TWITTER_UPLOAD_STATUS_MAX_WAIT: Final[int] = 60
+
+# ---- Alerts ---- #
+# repeats of the same error within this window are rolled up into a single digest
+ALERT_DIGEST_WINDOW_SECONDS: Final[int] = 6 * 60 * 60
+
+# ---- Circuit breakers ---- #
+# consecutive failures before a platform account is skipped
+CIRCUIT_FAILURE_THRESHOLD: Final[int] = 3
+CIRCUIT_COOLDOWN_SECONDS: Final[int] = 60 * 60
+CIRCUIT_MAX_COOLDOWN_SECONDS: Final[int] = 6 * 60 * 60
+
+# ---- Bluesky ---- #
+BLUESKY_PDS_UPLOAD_CONCURRENCY: Final[int] = 2
+
 REQUEST_TIMEOUT: Final[int] = 30
+CONNECT_TIMEOUT: Final[int] = 10
+
+# ---- HTTP connection pool ---- #
+POOL_MAX_CONNECTIONS: Final[int] = 100
+POOL_MAX_PER_HOST: Final[int] = 10
+POOL_KEEPALIVE_SECONDS: Final[int] = 3600 + 300 # keep connections open across hourly runs
+DNS_CACHE_TTL_SECONDS: Final[int] = 3600 + 300
+
 BASE_HEADERS: Final[Dict[str, str]] = {
 	"User-Agent": "HourlyAnimalPhotos (https://github.com/aprilsbloom/hourlyanimalphotos)",
 	"Accept": "*/*",
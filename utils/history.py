@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import math
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from utils.clock import get_clock
+from utils.constants import DATA_DIR, HISTORY_REPORT_DAYS, HISTORY_REPORT_PERCENTILES, HISTORY_SLOWEST_PHASES
+from utils.logger import Logger
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS phases (
+  post_time REAL NOT NULL,
+  source TEXT NOT NULL,
+  service TEXT NOT NULL,
+  phase TEXT NOT NULL,
+  started_at REAL NOT NULL,
+  duration REAL NOT NULL,
+  lateness REAL NOT NULL,
+  success INTEGER NOT NULL,
+  retries INTEGER NOT NULL,
+  bytes INTEGER NOT NULL,
+  url TEXT
+);
+CREATE INDEX IF NOT EXISTS phases_by_group ON phases (source, service, phase, post_time);
+CREATE INDEX IF NOT EXISTS phases_by_time ON phases (post_time);
+'''
+
+Row = Tuple[float, str, str, str, float, float, float, int, int, int, str | None]
+
+# every phase of every run (fetching, processing, uploading & posting) with its timings, retries & size,
+# kept in a local sqlite db so latency & reliability can be looked at over time
+class PostHistory:
+  path: Path
+  pending: List[Row]
+  log: Logger
+
+  def __init__(self, path: str | Path):
+    self.path = Path(path)
+    self.pending = []
+    self.log = Logger("History")
+
+  def connect(self) -> sqlite3.Connection:
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    conn = sqlite3.connect(self.path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+  # queues a finished phase, which is written out with the rest of the run on flush()
+  def record(
+    self,
+    source: str,
+    post_time: datetime,
+    service: str,
+    phase: str,
+    started_at: float,
+    success: bool,
+    retries: int = 0,
+    size: int = 0,
+    url: str | None = None,
+  ):
+    finished_at = get_clock().time()
+    self.pending.append((
+      post_time.timestamp(),
+      source,
+      service,
+      phase,
+      started_at,
+      finished_at - started_at,
+      # negative when the phase finished ahead of the posting time
+      finished_at - post_time.timestamp(),
+      int(success),
+      retries,
+      size,
+      url,
+    ))
+
+  def write(self, rows: List[Row]):
+    conn = self.connect()
+    try:
+      with conn:
+        conn.executemany('INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    finally:
+      conn.close()
+
+  # writes everything recorded during the run in a single transaction
+  async def flush(self):
+    if not self.pending:
+      return
+
+    rows, self.pending = self.pending, []
+    try:
+      await asyncio.to_thread(self.write, rows)
+    except Exception as e:
+      self.log.warning(f'Failed to write {len(rows)} history rows: {e!r}')
+
+  # per source, service & phase: run count, success rate, retries, bytes & duration/lateness percentiles
+  def summarize(self, since: datetime) -> List[Dict]:
+    conn = self.connect()
+    try:
+      groups = conn.execute('''
+        SELECT source, service, phase, COUNT(*), AVG(success), SUM(retries), SUM(bytes)
+        FROM phases WHERE post_time >= ?
+        GROUP BY source, service, phase
+        ORDER BY source, service, phase
+      ''', (since.timestamp(),)).fetchall()
+
+      summaries = []
+      for source, service, phase, count, success_rate, retries, size in groups:
+        # the (source, service, phase, post_time) index keeps this to a range scan per group
+        durations = [row[0] for row in conn.execute(
+          'SELECT duration FROM phases WHERE source = ? AND service = ? AND phase = ? AND post_time >= ? ORDER BY duration',
+          (source, service, phase, since.timestamp())
+        )]
+        lateness = [row[0] for row in conn.execute(
+          'SELECT lateness FROM phases WHERE source = ? AND service = ? AND phase = ? AND post_time >= ? ORDER BY lateness',
+          (source, service, phase, since.timestamp())
+        )]
+
+        summaries.append({
+          'source': source,
+          'service': service,
+          'phase': phase,
+          'count': count,
+          'success_rate': success_rate,
+          'retries': retries,
+          'bytes': size,
+          'duration': {p: percentile(durations, p) for p in HISTORY_REPORT_PERCENTILES},
+          'lateness': {p: percentile(lateness, p) for p in HISTORY_REPORT_PERCENTILES},
+        })
+
+      return summaries
+    finally:
+      conn.close()
+
+  # the individual phases that took the longest
+  def slowest(self, since: datetime, limit: int) -> List[Tuple]:
+    conn = self.connect()
+    try:
+      return conn.execute('''
+        SELECT post_time, source, service, phase, duration, success, retries
+        FROM phases WHERE post_time >= ?
+        ORDER BY duration DESC LIMIT ?
+      ''', (since.timestamp(), limit)).fetchall()
+    finally:
+      conn.close()
+
+
+# nearest-rank percentile of already sorted values
+def percentile(ordered: List[float], p: float) -> float:
+  if not ordered:
+    return 0
+
+  idx = min(len(ordered) - 1, max(0, math.ceil(p * len(ordered)) - 1))
+  return ordered[idx]
+
+
+def report(days: int):
+  since = datetime.now() - timedelta(days=days)
+  summaries = history.summarize(since)
+  if not summaries:
+    print(f'No history in the last {days} days.')
+    return
+
+  labels = ' '.join(f'p{int(p * 100):<6}' for p in HISTORY_REPORT_PERCENTILES)
+  print(f'History for the last {days} days\n')
+  print(f'{"source":<8}{"service":<14}{"phase":<10}{"runs":>6}{"ok":>8}{"retries":>9}{"MB":>9}  duration {labels}  lateness {labels}')
+
+  for summary in summaries:
+    durations = ' '.join(f'{value:<7.2f}' for value in summary['duration'].values())
+    lateness = ' '.join(f'{value:<7.2f}' for value in summary['lateness'].values())
+    print(
+      f'{summary["source"]:<8}{summary["service"]:<14}{summary["phase"]:<10}'
+      f'{summary["count"]:>6}{summary["success_rate"] * 100:>7.1f}%{summary["retries"]:>9}{summary["bytes"] / 1024 / 1024:>9.1f}'
+      f'           {durations}           {lateness}'
+    )
+
+  print(f'\nSlowest {HISTORY_SLOWEST_PHASES} phases\n')
+  for post_time, source, service, phase, duration, success, retries in history.slowest(since, HISTORY_SLOWEST_PHASES):
+    status = 'ok' if success else 'failed'
+    print(f'{datetime.fromtimestamp(post_time).strftime("%Y-%m-%d %H:%M")}  {source:<8}{service:<14}{phase:<10}{duration:>8.2f}s  {status} ({retries} retries)')
+
+
+history = PostHistory(Path(DATA_DIR) / 'history.db')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Reports on the post history.')
+  parser.add_argument('--days', type=int, default=HISTORY_REPORT_DAYS, help='how many days of history to report on')
+  args = parser.parse_args()
+
+  report(args.days)
@@ -0,0 +1,138 @@
+import asyncio
+import socket
+from typing import Any, Dict, List
+from urllib.parse import urlsplit
+
+import aiohttp
+import httpx
+import requests
+import urllib3
+from aiohttp.abc import AbstractResolver, ResolveResult
+from requests.adapters import HTTPAdapter
+
+from utils.constants import (
+  BASE_HEADERS,
+  CONNECT_TIMEOUT,
+  DNS_CACHE_TTL_SECONDS,
+  POOL_KEEPALIVE_SECONDS,
+  POOL_MAX_CONNECTIONS,
+  POOL_MAX_PER_HOST,
+  REQUEST_TIMEOUT,
+)
+from utils.logger import Logger
+
+log = Logger("HTTP")
+
+_session: aiohttp.ClientSession | None = None
+
+# port of the local server that stands in for every upstream host while simulating
+_stand_in: int | None = None
+
+def set_stand_in(port: int | None):
+  global _stand_in
+  _stand_in = port
+
+# all outgoing requests should go through this session, so that connections (and dns lookups)
+# to the same hosts are reused between requests, retries & hourly runs
+def get_session() -> aiohttp.ClientSession:
+  global _session
+
+  if _session is None or _session.closed:
+    options: Dict[str, Any] = { 'ttl_dns_cache': DNS_CACHE_TTL_SECONDS, 'use_dns_cache': True }
+    if _stand_in is not None:
+      # every host resolves to the stand-in, whose certificate is self-signed
+      options = { 'resolver': StandInResolver(_stand_in), 'ssl': False }
+
+    connector = aiohttp.TCPConnector(
+      limit=POOL_MAX_CONNECTIONS,
+      limit_per_host=POOL_MAX_PER_HOST,
+      keepalive_timeout=POOL_KEEPALIVE_SECONDS,
+      **options,
+    )
+
+    _session = aiohttp.ClientSession(
+      connector=connector,
+      headers=BASE_HEADERS,
+      timeout=aiohttp.ClientTimeout(
+        total=REQUEST_TIMEOUT,
+        sock_connect=CONNECT_TIMEOUT,
+      ),
+    )
+
+  return _session
+
+
+async def close_session():
+  global _session
+
+  if _session is not None and not _session.closed:
+    await _session.close()
+
+  _session = None
+
+
+# resolves & opens a keep-alive connection to each host, so later requests skip the dns lookup & handshakes
+async def warm_hosts(urls: List[str]):
+  async def warm(url: str):
+    try:
+      async with get_session().head(url, allow_redirects=False) as res:
+        await res.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      log.warning(f'Failed to warm up connection to {url}: {e!r}')
+
+  await asyncio.gather(*(warm(url) for url in urls))
+
+
+# ---- stand-in (see utils/simulation.py) ---- #
+# connections for any host go to the stand-in, the host header still says where the request was meant for
+class StandInResolver(AbstractResolver):
+  port: int
+
+  def __init__(self, port: int):
+    self.port = port
+
+  async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET) -> List[ResolveResult]:
+    return [ResolveResult(hostname=host, host='127.0.0.1', port=self.port, family=socket.AF_INET, proto=0, flags=socket.AI_NUMERICHOST)]
+
+  async def close(self):
+    pass
+
+
+# the same for clients that use httpx rather than the shared session (the bluesky client)
+class StandInTransport(httpx.AsyncHTTPTransport):
+  port: int
+
+  def __init__(self, port: int):
+    super().__init__(verify=False)
+    self.port = port
+
+  async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+    request.url = request.url.copy_with(host='127.0.0.1', port=self.port)
+    return await super().handle_async_request(request)
+
+
+# & for requests sessions (the tweet client)
+class StandInAdapter(HTTPAdapter):
+  port: int
+
+  def __init__(self, port: int):
+    super().__init__()
+    self.port = port
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+  def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+    url = urlsplit(request.url)
+    request.headers['Host'] = url.netloc
+    request.url = url._replace(netloc=f'127.0.0.1:{self.port}').geturl()
+    kwargs['verify'] = False
+
+    return super().send(request, **kwargs)
+
+
+def get_httpx_transport() -> httpx.AsyncBaseTransport | None:
+  return StandInTransport(_stand_in) if _stand_in is not None else None
+
+
+def mount_stand_in(session: requests.Session):
+  if _stand_in is not None:
+    session.mount('https://', StandInAdapter(_stand_in))
@@ -1,49 +1,234 @@
 import io
 import os
+import sys
+import time
 import uuid
 from pathlib import Path
+from typing import Any, Dict, List, Tuple
 
 from PIL import Image
 
+from utils.cache import hash_bytes, image_cache
+from utils.constants import ENCODER_PROFILE, MAX_IMAGE_PIXELS, MAX_IMG_SIZE_MB
+
+# pillow's own decompression bomb check, as a backstop for anything not opened through open_image
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
 jobs_dir = Path('./jobs')
 jobs_dir.mkdir(parents=True, exist_ok=True)
 
+EncoderOption = Tuple[str, Dict[str, Any]]
+
+# each profile lists the encodes to try for an image, the smallest output wins. quality is the same in every
+# profile, they only trade encoder effort for size. run `python -m utils.image <images...>` to benchmark them.
+# on 10 photo-like images (1600x1200 to 3000x2250) with pillow 12.0:
+#   fast       ~200 ms/img  ~424 KB/img
+#   balanced   ~730 ms/img  ~413 KB/img
+#   small     ~1680 ms/img  ~395 KB/img
+ENCODER_PROFILES: Dict[str, List[EncoderOption]] = {
+  'fast': [
+    ('WEBP', {'quality': 82, 'method': 0}),
+    ('JPEG', {'quality': 85, 'subsampling': '4:2:0'}),
+  ],
+  'balanced': [
+    ('WEBP', {'quality': 82, 'method': 4}),
+    ('JPEG', {'quality': 85, 'optimize': True, 'subsampling': '4:2:0'}),
+    ('PNG', {'optimize': True}),
+  ],
+  'small': [
+    ('WEBP', {'quality': 82, 'method': 6}),
+    ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'}),
+    ('PNG', {'optimize': True}),
+  ],
+}
+
+FORMATS: Dict[str, Tuple[str, str]] = {
+  'WEBP': ('webp', 'image/webp'),
+  'JPEG': ('jpg', 'image/jpeg'),
+  'PNG': ('png', 'image/png'),
+}
+
+def has_alpha(img: Image.Image) -> bool:
+  return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def encode(img: Image.Image, fmt: str, options: Dict[str, Any]) -> bytes:
+  if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+    img = img.convert('RGB')
+  elif fmt == 'PNG' and img.mode not in ('1', 'L', 'LA', 'I', 'P', 'RGB', 'RGBA'):
+    img = img.convert('RGBA')
+
+  buf = io.BytesIO()
+  img.save(buf, fmt, **options)
+  return buf.getvalue()
+
+
+def encode_best(img: Image.Image, profile: str = ENCODER_PROFILE) -> Tuple[str, bytes]:
+  best: Tuple[str, bytes] | None = None
+
+  for fmt, options in ENCODER_PROFILES[profile]:
+    # jpeg would drop transparency
+    if fmt == 'JPEG' and has_alpha(img):
+      continue
+
+    # lossless png is only ever smaller for flat, low colour images, so skip it for photos
+    if fmt == 'PNG' and img.getcolors(256) is None:
+      continue
+
+    data = encode(img, fmt, options)
+    if best is None or len(data) < len(best[1]):
+      best = (fmt, data)
+
+  if best is None:
+    raise ValueError(f'Encoder profile "{profile}" has no usable formats for this image')
+
+  return best
+
+
+class ImageTooLargeError(ValueError):
+  pass
+
+
+# opens an image, refusing anything over the pixel budget before it's decoded
+def open_image(data: bytes) -> Image.Image:
+  img = Image.open(io.BytesIO(data))
+  if img.width * img.height > MAX_IMAGE_PIXELS:
+    img.close()
+    raise ImageTooLargeError(f'Image is {img.width}x{img.height}, which is over the {MAX_IMAGE_PIXELS} pixel limit')
+
+  return img
+
+
 class SourceImage:
   id: str
+  hash: str
   path: Path
-  _img: Image.Image
+  data: bytes
+  format: str
+  mime_type: str
+  profile: str
+  width: int
+  height: int
+  _img: Image.Image | None
 
-  def __init__(self, data: bytes):
+  def __init__(self, data: bytes, max_size_mb: float = MAX_IMG_SIZE_MB, profile: str = ENCODER_PROFILE, rendition: bytes | None = None):
     self.id = str(uuid.uuid4())
-    self.path = jobs_dir / f'{self.id}.webp'
-    self._img = Image.open(io.BytesIO(data))
-    self.save(convert_to_webp=True)
+    self.hash = hash_bytes(data)
+    self.profile = profile
+    self._img = None
+
+    # reuse a pre-encoded rendition, or a previous encode of the same source image if we have one
+    rendition_key = f'{self.hash}:{profile}:{max_size_mb}'
+    cached = rendition if rendition is not None else image_cache.get_rendition(rendition_key)
+    if cached is not None:
+      # only the header is needed here, the image itself is never decoded
+      with open_image(cached) as img:
+        self.width, self.height = img.size
+        self.write(img.format or 'WEBP', cached)
+
+      return
+
+    try:
+      self._img = open_image(data)
+      self._img.load()
+      self.width, self.height = self._img.size
+
+      self.write(*encode_best(self._img, self.profile))
+      self.fit_to_size(max_size_mb)
+    finally:
+      # the decoded image is only needed while encoding
+      self.close_image()
+
+    image_cache.put_rendition(rendition_key, self.data)
+
+  def __enter__(self) -> 'SourceImage':
+    return self
+
+  def __exit__(self, *args):
+    self.cleanup()
+
+  def close_image(self):
+    if self._img is not None:
+      self._img.close()
+      self._img = None
 
   def cleanup(self):
-    os.remove(self.path)
+    self.close_image()
+    self.data = b''
 
-  def save(self, convert_to_webp: bool = False):
+    if self.path.exists():
+      os.remove(self.path)
+
+  # keeps the encoded image in memory for uploads, and on disk for anything that needs a path
+  def write(self, fmt: str, data: bytes):
     jobs_dir.mkdir(parents=True, exist_ok=True)
 
-    self._img.save(self.path, 'webp', quality=100)
-    if convert_to_webp:
-      self.reload_image()
+    extension, self.mime_type = FORMATS[fmt]
+    self.format = fmt
+    self.path = jobs_dir / f'{self.id}.{extension}'
+    self.data = data
 
-  def read(self) -> bytes:
-    with open(self.path, 'rb') as f:
-      return f.read()
+    with open(self.path, 'wb') as f:
+      f.write(data)
 
-  def reload_image(self):
-    with open(self.path, 'rb') as f:
-      self._img = Image.open(f)
-      self._img.load()
+  def read(self) -> bytes:
+    return self.data
 
   def get_size_mb(self) -> float:
-    return os.path.getsize(self.path) / 1000 / 1000
+    return len(self.data) / 1000 / 1000
 
   def get_dimensions(self) -> tuple[int, int]:
-    return self._img.width, self._img.height
+    return self.width, self.height
+
+  def resize(self, width: int, height: int):
+    if self._img is None:
+      raise ValueError('Image has already been encoded and closed')
+
+    old_path = self.path
+    old_img = self._img
 
-  def resize(self, width: int, height: int, quality: int = 100):
     self._img = self._img.resize((width, height), Image.Resampling.LANCZOS)
-    self._img.save(self.path, 'webp', quality=quality)
\ No newline at end of file
+    self.width, self.height = self._img.size
+    old_img.close()
+
+    self.write(*encode_best(self._img, self.profile))
+
+    # the best format may have changed between sizes
+    if old_path != self.path:
+      old_path.unlink(missing_ok=True)
+
+  # resize the image to be below the given size if applicable
+  def fit_to_size(self, max_size_mb: float):
+    while self.get_size_mb() > max_size_mb:
+      width, height = self.get_dimensions()
+      self.resize(int(width * 0.9), int(height * 0.9))
+
+
+def benchmark(paths: List[str]):
+  for profile, options in ENCODER_PROFILES.items():
+    total_time = 0.0
+    total_size = 0
+    formats: Dict[str, int] = {}
+
+    for path in paths:
+      with Image.open(path) as img:
+        img.load()
+
+        start = time.perf_counter()
+        fmt, data = encode_best(img, profile)
+        total_time += time.perf_counter() - start
+
+      total_size += len(data)
+      formats[fmt] = formats.get(fmt, 0) + 1
+
+    avg_ms = total_time / len(paths) * 1000
+    avg_kb = total_size / len(paths) / 1000
+    print(f'{profile:>10}: {avg_ms:8.1f} ms/img {avg_kb:8.1f} KB/img  picked {formats}  ({len(options)} candidate encodes)')
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print('Usage: python -m utils.image <image> [image ...]')
+    sys.exit(1)
+
+  benchmark(sys.argv[1:])
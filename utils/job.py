@@ -0,0 +1,39 @@
+from datetime import datetime
+from typing import Any, Dict, List
+
+from utils.config import AnimalConfig
+from utils.image import SourceImage
+
+
+# the images that have been fetched & prepared ahead of the posting time,
+# along with anything the platforms uploaded for them in advance
+class PostJob:
+  id: str
+  source_cfg: AnimalConfig
+  images: List[SourceImage]
+  img_urls: List[str]
+  post_time: datetime
+  media: Dict[str, Any]
+
+  def __init__(self, source_cfg: AnimalConfig, images: List[SourceImage], img_urls: List[str], post_time: datetime):
+    self.id = images[0].id
+    self.source_cfg = source_cfg
+    self.images = images
+    self.img_urls = img_urls
+    self.post_time = post_time
+    self.media = {}
+
+  # the images a platform should post, based on its album size
+  def album(self, platform: str) -> List[SourceImage]:
+    return self.images[:self.source_cfg[platform]['album_size']] # type: ignore
+
+  # how many bytes of images a platform will send
+  def album_bytes(self, platform: str) -> int:
+    return sum(len(img.read()) for img in self.album(platform))
+
+  # releases the image & anything uploaded for it once the job is done
+  def close(self):
+    for img in self.images:
+      img.cleanup()
+
+    self.media.clear()
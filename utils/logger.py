@@ -1,4 +1,4 @@
-from datetime import datetime
+from utils.clock import get_clock
 
 colors = {
   "red": "\033[91m",
@@ -16,7 +16,7 @@ class Logger:
 
   @staticmethod
   def fetch_time():
-    time = datetime.now().strftime("%H:%M:%S")
+    time = get_clock().now().strftime("%H:%M:%S")
     return f"[{time}]"
 
   def info(self, *args, **kwargs):
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+from utils.constants import MEMORY_CHECK_INTERVAL_SECONDS, MEMORY_REPORT_TOP, MEMORY_RSS_THRESHOLD_MB, MEMORY_TRACE_FRAMES
+from utils.logger import Logger
+
+log = Logger("Memory")
+
+def get_rss_mb() -> float:
+  # current rss where we can read it, otherwise the peak
+  try:
+    with open('/proc/self/statm', 'r') as f:
+      resident_pages = int(f.read().split()[1])
+
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1000 / 1000
+  except (OSError, ValueError, IndexError):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes everywhere else
+    return peak / 1000 / 1000 if sys.platform == 'darwin' else peak / 1000
+
+
+# periodically checks rss, and once it passes the threshold reports where memory has been allocated
+# (and what has grown since startup) if allocation tracing is enabled
+class MemoryWatchdog:
+  trace: bool
+  threshold_mb: float
+  last_report: float
+
+  def __init__(self, trace: bool = False, threshold_mb: float = MEMORY_RSS_THRESHOLD_MB):
+    self.trace = trace
+    self.threshold_mb = threshold_mb
+    self.last_report = 0
+    self._baseline: tracemalloc.Snapshot | None = None
+    self._task: asyncio.Task | None = None
+
+  def start(self):
+    if self.trace:
+      tracemalloc.start(MEMORY_TRACE_FRAMES)
+      self._baseline = tracemalloc.take_snapshot()
+
+    self._task = asyncio.create_task(self._run(), name='memory-watchdog')
+
+  async def _run(self):
+    while True:
+      await asyncio.sleep(MEMORY_CHECK_INTERVAL_SECONDS)
+      self.check()
+
+  def check(self):
+    rss = get_rss_mb()
+    if rss < self.threshold_mb:
+      return
+
+    # don't spam the logs while memory stays high
+    if time.monotonic() - self.last_report < 60 * 60:
+      return
+
+    self.last_report = time.monotonic()
+    log.warning(f'RSS is {rss:.1f} MB, over the {self.threshold_mb} MB threshold.')
+
+    if not self.trace:
+      log.info('Run with --trace-memory to see where memory is being allocated.')
+      return
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+      tracemalloc.Filter(False, tracemalloc.__file__),
+      tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+    lines = ['Top allocation sites:']
+    for stat in snapshot.statistics('lineno')[:MEMORY_REPORT_TOP]:
+      lines.append(f'  {stat}')
+
+    if self._baseline is not None:
+      lines.append('Largest growth since startup:')
+      for diff in snapshot.compare_to(self._baseline, 'lineno')[:MEMORY_REPORT_TOP]:
+        lines.append(f'  {diff}')
+
+    log.warning('\n'.join(lines))
@@ -0,0 +1,50 @@
+from functools import lru_cache
+from typing import Dict
+from urllib.parse import urlencode
+
+from oauthlib.oauth1 import Client
+
+
+class OAuth1Signer:
+  client: Client
+
+  def __init__(self, consumer_key: str, consumer_secret: str, token: str, token_secret: str):
+    self.client = Client(
+      client_key=consumer_key,
+      client_secret=consumer_secret,
+      resource_owner_key=token,
+      resource_owner_secret=token_secret,
+    )
+
+  # returns the url (with query params) & headers to send the request with.
+  # form params are included in the signature, multipart bodies are not (per the oauth1 spec)
+  def sign(
+    self,
+    method: str,
+    url: str,
+    params: Dict[str, str] | None = None,
+    form: Dict[str, str] | None = None,
+  ) -> tuple[str, Dict[str, str]]:
+    if params:
+      url = f'{url}?{urlencode(params)}'
+
+    body = None
+    headers = {}
+    if form:
+      body = urlencode(form)
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    signed_url, signed_headers, _ = self.client.sign(
+      url,
+      http_method=method,
+      body=body,
+      headers=headers,
+    )
+
+    return signed_url, signed_headers
+
+
+# signers are cached per set of credentials so they're reused between runs
+@lru_cache(maxsize=None)
+def get_signer(consumer_key: str, consumer_secret: str, token: str, token_secret: str) -> OAuth1Signer:
+  return OAuth1Signer(consumer_key, consumer_secret, token, token_secret)
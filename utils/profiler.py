@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from types import FrameType
+from typing import Any, Callable, Dict, List, Tuple
+
+from utils.constants import PROFILE_DIR, PROFILE_INTERVAL_SECONDS, PROFILE_KEEP
+from utils.logger import Logger
+
+Frame = Tuple[str, str, int]
+
+log = Logger("Profiler")
+
+# a low overhead sampling profiler. a helper thread periodically grabs the event loop thread's stack,
+# attributing each sample to whichever asyncio task was running at the time. work handed off to threads
+# (asyncio.to_thread, run_in_executor) is sampled too, under the task that handed it off
+class SamplingProfiler:
+  interval: float
+  samples: Dict[Tuple[str, Tuple[Frame, ...]], int]
+  paused: bool
+  # executor threads currently running work, and the task that submitted it
+  threads: Dict[int, str]
+
+  def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS):
+    self.interval = interval
+    self.samples = {}
+    self.paused = False
+    self.threads = {}
+    self._stop = threading.Event()
+    self._thread: threading.Thread | None = None
+    self._loop: asyncio.AbstractEventLoop | None = None
+    self._thread_id = 0
+    self._started_at = 0.0
+    self._duration = 0.0
+
+  def start(self):
+    self._loop = asyncio.get_running_loop()
+    self._thread_id = threading.get_ident()
+    self._started_at = time.perf_counter()
+    self._stop.clear()
+
+    # to_thread goes through run_in_executor, so wrapping it on the loop covers both
+    submit = self._loop.run_in_executor
+    self._loop.run_in_executor = functools.partial(self._run_in_executor, submit) # type: ignore
+
+    self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+    if self._loop is not None:
+      self._loop.__dict__.pop('run_in_executor', None)
+
+    self._duration = time.perf_counter() - self._started_at
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      if not self.paused:
+        self.sample()
+
+  def _run_in_executor(self, submit: Callable[..., asyncio.Future], executor: Any, func: Callable[..., Any], *args: Any) -> asyncio.Future:
+    task = asyncio.current_task(self._loop)
+    task_name = task.get_name() if task is not None else '(event loop)'
+    return submit(executor, functools.partial(self._run_in_thread, task_name, func, *args))
+
+  def _run_in_thread(self, task_name: str, func: Callable[..., Any], *args: Any) -> Any:
+    thread_id = threading.get_ident()
+    self.threads[thread_id] = task_name
+    try:
+      return func(*args)
+    finally:
+      self.threads.pop(thread_id, None)
+
+  def sample(self):
+    frames = sys._current_frames()
+
+    frame = frames.get(self._thread_id)
+    if frame is not None:
+      task = asyncio.current_task(self._loop) if self._loop is not None else None
+      self.add(task.get_name() if task is not None else '(event loop)', frame)
+
+    for thread_id, task_name in list(self.threads.items()):
+      frame = frames.get(thread_id)
+      if frame is not None:
+        self.add(task_name, frame)
+
+  def add(self, task_name: str, frame: FrameType):
+    stack: List[Frame] = []
+    current: FrameType | None = frame
+    while current is not None:
+      code = current.f_code
+      # the executor's own frames below the handed off work aren't interesting
+      if code is SamplingProfiler._run_in_thread.__code__:
+        break
+
+      stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+      current = current.f_back
+
+    # root first
+    key = (task_name, tuple(reversed(stack)))
+    self.samples[key] = self.samples.get(key, 0) + 1
+
+  # writes the samples as a speedscope profile (https://www.speedscope.app), one profile per task
+  def export(self, path: Path):
+    frames: List[Dict[str, str | int]] = []
+    frame_idx: Dict[Frame, int] = {}
+    profiles: Dict[str, Dict[str, list]] = {}
+
+    for (task_name, stack), count in self.samples.items():
+      indices = []
+      for frame in stack:
+        if frame not in frame_idx:
+          frame_idx[frame] = len(frames)
+          frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+
+        indices.append(frame_idx[frame])
+
+      profile = profiles.setdefault(task_name, {'samples': [], 'weights': []})
+      profile['samples'].append(indices)
+      profile['weights'].append(count * self.interval)
+
+    data = {
+      '$schema': 'https://www.speedscope.app/file-format-schema.json',
+      'name': path.stem,
+      'exporter': 'hourlyanimalphotos',
+      'activeProfileIndex': 0,
+      'shared': {'frames': frames},
+      'profiles': [
+        {
+          'type': 'sampled',
+          'name': task_name,
+          'unit': 'seconds',
+          'startValue': 0,
+          'endValue': sum(profile['weights']),
+          'samples': profile['samples'],
+          'weights': profile['weights'],
+        }
+        # busiest tasks first
+        for task_name, profile in sorted(profiles.items(), key=lambda item: -sum(item[1]['weights']))
+      ],
+    }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+      json.dump(data, f)
+
+
+# decides which runs get profiled & keeps the profile directory rotated
+class RunProfiler:
+  every: int
+  runs: int
+  profiler: SamplingProfiler | None
+
+  def __init__(self, every: int):
+    self.every = every
+    self.runs = 0
+    self.profiler = None
+
+  def start(self):
+    self.runs += 1
+    if self.every <= 0 or (self.runs - 1) % self.every != 0:
+      return
+
+    self.profiler = SamplingProfiler()
+    self.profiler.start()
+
+  # time spent sleeping until the posting time isn't worth sampling
+  def pause(self):
+    if self.profiler is not None:
+      self.profiler.paused = True
+
+  def resume(self):
+    if self.profiler is not None:
+      self.profiler.paused = False
+
+  def stop(self):
+    if self.profiler is None:
+      return
+
+    self.profiler.stop()
+
+    path = Path(PROFILE_DIR) / f'run-{datetime.now().strftime("%Y%m%d-%H%M%S")}.speedscope.json'
+    self.profiler.export(path)
+    self.profiler = None
+    log.info(f'Wrote profile to {path}')
+
+    self.rotate()
+
+  def rotate(self):
+    profiles = sorted(Path(PROFILE_DIR).glob('run-*.speedscope.json'))
+    for path in profiles[:-PROFILE_KEEP]:
+      path.unlink(missing_ok=True)
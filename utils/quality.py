@@ -0,0 +1,126 @@
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+from utils.constants import (
+  QUALITY_DRAFT_SIZE,
+  QUALITY_MAX_LETTERBOX,
+  QUALITY_MIN_DIMENSION,
+  QUALITY_MIN_ENTROPY,
+  QUALITY_MIN_SHARPNESS,
+  QUALITY_UNIFORM_STD,
+)
+from utils.image import ImageTooLargeError, open_image
+
+
+class QualityScore:
+  width: int
+  height: int
+  sharpness: float
+  entropy: float
+  letterbox: float
+  reasons: List[str]
+
+  def __init__(self, width: int = 0, height: int = 0, sharpness: float = 0, entropy: float = 0, letterbox: float = 0):
+    self.width = width
+    self.height = height
+    self.sharpness = sharpness
+    self.entropy = entropy
+    self.letterbox = letterbox
+    self.reasons = []
+
+    if min(width, height) < QUALITY_MIN_DIMENSION:
+      self.reasons.append(f'too small ({width}x{height})')
+
+    if sharpness < QUALITY_MIN_SHARPNESS:
+      self.reasons.append(f'too blurry (sharpness {sharpness:.1f})')
+
+    if entropy < QUALITY_MIN_ENTROPY:
+      self.reasons.append(f'too plain (entropy {entropy:.2f})')
+
+    if letterbox > QUALITY_MAX_LETTERBOX:
+      self.reasons.append(f'letterboxed ({letterbox:.0%} border)')
+
+  @property
+  def passed(self) -> bool:
+    return len(self.reasons) == 0
+
+  def __str__(self) -> str:
+    return ', '.join(self.reasons) if self.reasons else 'ok'
+
+
+# decodes a low resolution greyscale version of the image, letting the decoder skip most of the work where
+# it can (jpeg can decode straight to 1/2, 1/4 or 1/8 scale)
+def draft_decode(data: bytes) -> tuple[np.ndarray, int, int]:
+  with open_image(data) as img:
+    width, height = img.size
+
+    img.draft('L', (QUALITY_DRAFT_SIZE, QUALITY_DRAFT_SIZE))
+    small = img.convert('L').resize((QUALITY_DRAFT_SIZE, QUALITY_DRAFT_SIZE), Image.Resampling.BILINEAR)
+
+  return np.asarray(small, dtype=np.float32), width, height
+
+
+# scores a batch of (N, S, S) greyscale images at once
+def score_arrays(arrays: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  # sharpness: variance of the laplacian
+  laplacian = (
+    arrays[:, :-2, 1:-1] + arrays[:, 2:, 1:-1] +
+    arrays[:, 1:-1, :-2] + arrays[:, 1:-1, 2:] -
+    4 * arrays[:, 1:-1, 1:-1]
+  )
+  sharpness = laplacian.reshape(len(arrays), -1).var(axis=1)
+
+  # entropy of the greyscale histogram
+  pixels = arrays.astype(np.uint8).reshape(len(arrays), -1)
+  offsets = (np.arange(len(arrays)) * 256)[:, None]
+  histograms = np.bincount((pixels + offsets).ravel(), minlength=len(arrays) * 256).reshape(len(arrays), 256)
+  probabilities = histograms / pixels.shape[1]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    entropy = -np.nansum(probabilities * np.log2(probabilities), axis=1)
+
+  # letterboxing: how much of the image is made of uniform rows/columns touching the edges
+  uniform_rows = arrays.std(axis=2) < QUALITY_UNIFORM_STD
+  uniform_cols = arrays.std(axis=1) < QUALITY_UNIFORM_STD
+
+  def edge_run(mask: np.ndarray) -> np.ndarray:
+    leading = np.cumprod(mask, axis=1).sum(axis=1)
+    trailing = np.cumprod(mask[:, ::-1], axis=1).sum(axis=1)
+    return np.minimum(leading + trailing, mask.shape[1]) / mask.shape[1]
+
+  letterbox = np.maximum(edge_run(uniform_rows), edge_run(uniform_cols))
+
+  return sharpness, entropy, letterbox
+
+
+def score_batch(images: List[bytes]) -> List[QualityScore]:
+  scores: List[QualityScore | None] = [None] * len(images)
+  arrays = []
+  sizes = []
+  decoded_idx = []
+
+  for idx, data in enumerate(images):
+    try:
+      array, width, height = draft_decode(data)
+    except Exception as e:
+      score = QualityScore()
+      score.reasons = [str(e) if isinstance(e, ImageTooLargeError) else 'corrupt']
+      scores[idx] = score
+      continue
+
+    arrays.append(array)
+    sizes.append((width, height))
+    decoded_idx.append(idx)
+
+  if arrays:
+    sharpness, entropy, letterbox = score_arrays(np.stack(arrays))
+    for i, idx in enumerate(decoded_idx):
+      width, height = sizes[i]
+      scores[idx] = QualityScore(width, height, float(sharpness[i]), float(entropy[i]), float(letterbox[i]))
+
+  return [score for score in scores if score is not None]
+
+
+def score(data: bytes) -> QualityScore:
+  return score_batch([data])[0]
@@ -0,0 +1,325 @@
+import asyncio
+import base64
+import io
+import json
+import random
+import ssl
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+from aiohttp import web
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from PIL import Image
+
+from utils.cache import image_cache
+from utils.circuit import circuits
+from utils.clock import VirtualClock
+from utils.config import Config
+from utils.constants import (
+  CACHE_DIR,
+  DATA_DIR,
+  HISTORY_REPORT_PERCENTILES,
+  SIMULATION_IMAGES,
+  SIMULATION_LATENCY_SPREAD,
+  SIMULATION_PLATFORM_FAILURE_RATE,
+  SIMULATION_POST_LATENCY_SECONDS,
+  SIMULATION_SOURCE_FAILURE_RATE,
+  SIMULATION_SOURCE_LATENCY_SECONDS,
+  SIMULATION_UPLOAD_LATENCY_SECONDS,
+)
+from utils.history import history, percentile
+from utils.http import set_stand_in
+from utils.logger import Logger
+
+log = Logger("Simulation")
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+# credentials the stand-in accepts for any platform that's enabled without them
+PLACEHOLDER_CREDENTIALS = {
+  'twitter': ('consumer_key', 'consumer_secret', 'access_token', 'access_token_secret'),
+  'tumblr': ('blogname', 'consumer_key', 'consumer_secret', 'oauth_token', 'oauth_token_secret'),
+  'bluesky': ('username', 'app_password'),
+}
+
+# a cid the stand-in hands out for every uploaded blob
+BLOB_CID = 'bafkreihdwdcefgh4dqkjv67uzcmw7ojee6xedzdetojuzjevtenxquvyku'
+
+# noise images are distinct, sharp & detailed enough to get through validation & the quality prefilter
+def create_images(rng: random.Random) -> List[bytes]:
+  images = []
+  for _ in range(SIMULATION_IMAGES):
+    img = Image.frombytes('L', (1200, 900), rng.randbytes(1200 * 900)).convert('RGB')
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=70)
+    images.append(buffer.getvalue())
+
+  return images
+
+
+# a throwaway self-signed certificate, the clients skip verification while simulating
+def create_ssl_context() -> ssl.SSLContext:
+  key = ec.generate_private_key(ec.SECP256R1())
+  name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'simulation')])
+  now = datetime.now(timezone.utc)
+  cert = (
+    x509.CertificateBuilder()
+    .subject_name(name)
+    .issuer_name(name)
+    .public_key(key.public_key())
+    .serial_number(x509.random_serial_number())
+    .not_valid_before(now - timedelta(days=1))
+    .not_valid_after(now + timedelta(days=1))
+    .sign(key, hashes.SHA256())
+  )
+
+  context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+  with tempfile.TemporaryDirectory() as tmp:
+    cert_path, key_path = Path(tmp) / 'cert.pem', Path(tmp) / 'key.pem'
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    context.load_cert_chain(cert_path, key_path)
+
+  return context
+
+
+# an unsigned jwt, the bluesky client only reads the expiry out of it
+def create_jwt(subject: str) -> str:
+  def encode(data: Dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+  return f'{encode({"alg": "none"})}.{encode({"sub": subject, "exp": int(time.time()) + 365 * 24 * 60 * 60})}.'
+
+
+# runs the posting loop for a number of hours on a virtual clock. every request the real clients make
+# (sources, uploads, posts, logins & webhooks) goes to a local server standing in for the upstream hosts,
+# which answers after a seeded latency, occasionally fails & counts the requests to each host per simulated hour
+class Simulation:
+  clock: VirtualClock
+  end: datetime
+  rng: random.Random
+  images: List[bytes]
+  load: Dict[datetime, Dict[str, int]]
+  ids: int
+  blog_names: List[str]
+  runner: web.AppRunner | None
+
+  def __init__(self, clock: VirtualClock, hours: int, seed: int):
+    self.clock = clock
+    self.end = clock.now() + timedelta(hours=hours)
+    self.rng = random.Random(seed)
+    self.images = create_images(self.rng)
+    self.load = defaultdict(lambda: defaultdict(int))
+    self.ids = 0
+    self.blog_names = []
+    self.runner = None
+
+    # keep simulated runs out of the real history, circuit states & cache
+    history.path = Path(DATA_DIR) / 'simulation.db'
+    history.path.unlink(missing_ok=True)
+
+    circuits.path = Path(DATA_DIR) / 'simulation-circuits.json'
+    circuits.path.unlink(missing_ok=True)
+    circuits.breakers.clear()
+
+    image_cache.open(Path(CACHE_DIR) / 'simulation')
+
+  def running(self) -> bool:
+    return self.clock.now() < self.end
+
+  def next_id(self) -> str:
+    self.ids += 1
+    return str(self.ids)
+
+  # a latency around the given median, with the occasional slow outlier
+  def latency(self, median: float) -> float:
+    return median * self.rng.lognormvariate(0, SIMULATION_LATENCY_SPREAD)
+
+  def fails(self, rate: float) -> bool:
+    return self.rng.random() < rate
+
+  # fills in anything the enabled platforms need to log in (the stand-in accepts anything), & points the webhooks
+  # at the stand-in so alerts & post notifications are sent (& counted) too
+  def configure(self, cfg: Config):
+    for key in ('cat', 'dog'):
+      source_cfg = cfg.cfg[key]
+      for platform, fields in PLACEHOLDER_CREDENTIALS.items():
+        for field in fields:
+          if source_cfg[platform]['enabled'] and not source_cfg[platform][field]:
+            source_cfg[platform][field] = f'simulated-{key}'
+
+      self.blog_names.append(source_cfg['tumblr']['blogname'])
+      # (discord.py checks the id & token look real)
+      for idx, webhook in enumerate(source_cfg['webhooks']):
+        source_cfg['webhooks'][webhook] = f'https://discord.com/api/webhooks/{10 ** 17 + idx}/{f"simulated-{key}-{webhook}":x<68}'
+
+  async def start(self, cfg: Config):
+    self.configure(cfg)
+
+    app = web.Application(middlewares=[self.upstream], client_max_size=64 * 1024 * 1024)
+    app.router.add_route('*', '/{path:.*}', self.route)
+
+    self.runner = web.AppRunner(app, access_log=None)
+    await self.runner.setup()
+
+    site = web.TCPSite(self.runner, '127.0.0.1', 0, ssl_context=create_ssl_context())
+    await site.start()
+
+    port = self.runner.addresses[0][1]
+    set_stand_in(port)
+    log.info(f'Standing in for the upstream apis on port {port}')
+
+  async def stop(self):
+    set_stand_in(None)
+    if self.runner is not None:
+      await self.runner.cleanup()
+      self.runner = None
+
+  # ---- stand-in server ---- #
+  # counts every request against its host & simulated hour, then answers it after a latency (or fails it)
+  @web.middleware
+  async def upstream(self, request: web.Request, handler: Handler) -> web.StreamResponse:
+    host = request.host.split(':')[0]
+    hour = self.clock.now().replace(minute=0, second=0, microsecond=0)
+    self.load[hour][host] += 1
+
+    if host.startswith(('api.the', 'cdn2.the')):
+      median, failure_rate = SIMULATION_SOURCE_LATENCY_SECONDS, SIMULATION_SOURCE_FAILURE_RATE
+    elif host == 'upload.twitter.com' or request.path.endswith('uploadBlob'):
+      median, failure_rate = SIMULATION_UPLOAD_LATENCY_SECONDS, SIMULATION_PLATFORM_FAILURE_RATE
+    else:
+      median, failure_rate = SIMULATION_POST_LATENCY_SECONDS, SIMULATION_PLATFORM_FAILURE_RATE
+
+    # read the whole body before answering, as a real api would
+    await request.read()
+    await asyncio.sleep(self.latency(median))
+
+    if self.fails(failure_rate):
+      return web.json_response({ 'error': 'simulated failure' }, status=503)
+
+    return await handler(request)
+
+  async def route(self, request: web.Request) -> web.StreamResponse:
+    host = request.host.split(':')[0]
+
+    # connection warm-ups
+    if request.method == 'HEAD':
+      return web.Response()
+
+    if host.startswith('api.the'):
+      return self.search(request)
+    if host.startswith('cdn2.the'):
+      return self.image(request)
+    if host == 'upload.twitter.com':
+      return self.twitter_upload(request)
+    if host == 'api.twitter.com':
+      return self.twitter_api(request)
+    if host == 'api.tumblr.com':
+      return self.tumblr_api(request)
+    if host == 'discord.com':
+      return web.Response(status=204)
+    if request.path.startswith('/xrpc/'):
+      return await self.bluesky_api(request)
+
+    return web.json_response({ 'error': f'{host} is not stood in for' }, status=404)
+
+  def search(self, request: web.Request) -> web.Response:
+    idx = self.rng.randrange(len(self.images))
+    domain = request.host.split(':')[0].removeprefix('api.')
+    return web.json_response([{ 'id': f'simulated{idx}', 'url': f'https://cdn2.{domain}/images/simulated-{idx}.jpg', 'width': 1200, 'height': 900 }])
+
+  def image(self, request: web.Request) -> web.Response:
+    try:
+      idx = int(request.path.rsplit('-', 1)[1].split('.')[0])
+      return web.Response(body=self.images[idx], content_type='image/jpeg')
+    except (IndexError, ValueError):
+      return web.Response(status=404)
+
+  def twitter_upload(self, request: web.Request) -> web.Response:
+    command = request.query.get('command')
+    if command == 'INIT':
+      media_id = self.next_id()
+      return web.json_response({ 'media_id': int(media_id), 'media_id_string': media_id }, status=202)
+    if command == 'APPEND':
+      return web.Response(status=204)
+    if command == 'FINALIZE':
+      return web.json_response({ 'media_id_string': request.query.get('media_id') }, status=201)
+    if command == 'STATUS':
+      return web.json_response({ 'media_id_string': request.query.get('media_id'), 'processing_info': { 'state': 'succeeded' } })
+
+    return web.json_response({ 'error': f'unknown command {command}' }, status=400)
+
+  def twitter_api(self, request: web.Request) -> web.Response:
+    if request.path == '/2/tweets':
+      return web.json_response({ 'data': { 'id': self.next_id(), 'text': '' } }, status=201)
+    if request.path == '/2/users/me':
+      return web.json_response({ 'data': { 'id': '1', 'name': 'Simulated', 'username': 'simulated' } })
+
+    return web.json_response({ 'error': 'not found' }, status=404)
+
+  def tumblr_api(self, request: web.Request) -> web.Response:
+    if request.path.endswith('/posts'):
+      return web.json_response({ 'meta': { 'status': 201, 'msg': 'Created' }, 'response': { 'id': self.next_id() } }, status=201)
+    if request.path == '/v2/user/info':
+      blogs = [{ 'name': blog_name } for blog_name in self.blog_names]
+      return web.json_response({ 'meta': { 'status': 200, 'msg': 'OK' }, 'response': { 'user': { 'name': 'simulated', 'blogs': blogs } } })
+
+    return web.json_response({ 'meta': { 'status': 404, 'msg': 'Not Found' }, 'response': [] }, status=404)
+
+  async def bluesky_api(self, request: web.Request) -> web.Response:
+    nsid = request.path.removeprefix('/xrpc/')
+    if nsid in ('com.atproto.server.createSession', 'com.atproto.server.refreshSession', 'com.atproto.server.getSession'):
+      handle = (await request.json()).get('identifier', 'simulated') if nsid == 'com.atproto.server.createSession' else 'simulated'
+      did = 'did:plc:simulated'
+      return web.json_response({
+        'did': did,
+        'handle': handle,
+        'accessJwt': create_jwt(did),
+        'refreshJwt': create_jwt(did),
+      })
+    if nsid == 'app.bsky.actor.getProfile':
+      return web.json_response({ 'did': 'did:plc:simulated', 'handle': request.query.get('actor', 'simulated') })
+    if nsid == 'com.atproto.repo.uploadBlob':
+      body = await request.read()
+      return web.json_response({ 'blob': { '$type': 'blob', 'ref': { '$link': BLOB_CID }, 'mimeType': request.content_type, 'size': len(body) } })
+    if nsid == 'com.atproto.repo.createRecord':
+      return web.json_response({ 'uri': f'at://did:plc:simulated/app.bsky.feed.post/{self.next_id()}', 'cid': BLOB_CID })
+
+    return web.json_response({ 'error': 'MethodNotImplemented', 'message': nsid }, status=501)
+
+  def report(self, start: datetime):
+    print()
+    log.info(f'Simulated {start.strftime("%Y-%m-%d %H:%M")} to {self.clock.now().strftime("%Y-%m-%d %H:%M")}')
+
+    # how far after the hour each post went out
+    print('\nSchedule accuracy (seconds after the hour)\n')
+    print(f'{"source":<8}{"platform":<10}{"posts":>6}{"ok":>8}  ' + ' '.join(f'p{int(p * 100):<7}' for p in HISTORY_REPORT_PERCENTILES))
+    for summary in history.summarize(start):
+      if summary['phase'] != 'post':
+        continue
+
+      lateness = ' '.join(f'{value:<8.2f}' for value in summary['lateness'].values())
+      print(
+        f'{summary["source"]:<8}{summary["service"]:<10}{summary["count"]:>6}{summary["success_rate"] * 100:>7.1f}%  '
+        f'{lateness}'
+      )
+
+    # requests the clients actually sent to each upstream host, per simulated hour
+    hosts = sorted({host for counts in self.load.values() for host in counts})
+    print('\nUpstream requests per hour\n')
+    print(f'{"hour":<18}' + ''.join(f'{host:>20}' for host in hosts) + f'{"total":>8}')
+    for hour in sorted(self.load):
+      counts = self.load[hour]
+      print(f'{hour.strftime("%Y-%m-%d %H:%M"):<18}' + ''.join(f'{counts.get(host, 0):>20}' for host in hosts) + f'{sum(counts.values()):>8}')
+
+    totals = sorted(sum(counts.values()) for counts in self.load.values())
+    if totals:
+      print(f'\nPer hour: avg {sum(totals) / len(totals):.1f}, p99 {percentile(totals, 0.99)}, max {totals[-1]}')
@@ -0,0 +1,97 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, TypedDict
+
+from utils.constants import LOOP_MONITOR_INTERVAL_SECONDS, LOOP_STALL_HISTORY, LOOP_STALL_THRESHOLD_SECONDS
+from utils.logger import Logger
+
+log = Logger("Watchdog")
+
+class StallReport(TypedDict):
+  at: float
+  duration: float
+  task: str
+  stack: str
+
+
+# measures how late the event loop is to run a callback, and captures what's blocking it when it stalls.
+# the stack is grabbed from a helper thread, as the loop itself can't run anything while it's blocked
+class LoopMonitor:
+  interval: float
+  threshold: float
+  lag: float
+  max_lag: float
+  stalls: Deque[StallReport]
+
+  def __init__(self, interval: float = LOOP_MONITOR_INTERVAL_SECONDS, threshold: float = LOOP_STALL_THRESHOLD_SECONDS):
+    self.interval = interval
+    self.threshold = threshold
+    self.lag = 0
+    self.max_lag = 0
+    self.stalls = deque(maxlen=LOOP_STALL_HISTORY)
+
+    self._heartbeat = time.monotonic()
+    self._loop: asyncio.AbstractEventLoop | None = None
+    self._thread_id = 0
+    self._task: asyncio.Task | None = None
+    self._stop = threading.Event()
+    self._thread: threading.Thread | None = None
+
+  def start(self):
+    self._loop = asyncio.get_running_loop()
+    self._thread_id = threading.get_ident()
+    self._heartbeat = time.monotonic()
+    self._stop.clear()
+
+    self._task = asyncio.create_task(self._tick(), name='loop-monitor')
+    self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+    self._thread.start()
+
+  async def stop(self):
+    self._stop.set()
+    if self._task is not None:
+      self._task.cancel()
+      await asyncio.gather(self._task, return_exceptions=True)
+
+    if self._thread is not None:
+      self._thread.join()
+
+  async def _tick(self):
+    loop = asyncio.get_running_loop()
+
+    while True:
+      expected = loop.time() + self.interval
+      await asyncio.sleep(self.interval)
+
+      self.lag = max(loop.time() - expected, 0)
+      self.max_lag = max(self.max_lag, self.lag)
+      self._heartbeat = time.monotonic()
+
+  def _watch(self):
+    reported_heartbeat = 0.0
+
+    while not self._stop.wait(self.interval / 2):
+      heartbeat = self._heartbeat
+      stalled_for = time.monotonic() - heartbeat - self.interval
+      if stalled_for < self.threshold or heartbeat == reported_heartbeat:
+        continue
+
+      # only report each stall once
+      reported_heartbeat = heartbeat
+      self.report(stalled_for)
+
+  def report(self, stalled_for: float):
+    frame = sys._current_frames().get(self._thread_id)
+    if frame is None:
+      return
+
+    task = asyncio.current_task(self._loop) if self._loop is not None else None
+    task_name = task.get_name() if task is not None else '(event loop)'
+    stack = ''.join(traceback.format_stack(frame))
+
+    self.stalls.append(StallReport(at=time.time(), duration=stalled_for, task=task_name, stack=stack))
+    log.warning(f'Event loop blocked for {stalled_for:.2f}s+ in task "{task_name}":\n{stack}')
@@ -3,10 +3,11 @@ import json
 import traceback
 from typing import List
 
-import aiohttp
 import discord
 import requests
 
+from utils.http import get_session
+
 
 async def send_to_webhook(
   url: str,
@@ -21,71 +22,78 @@ async def send_to_webhook(
   if not url:
     return
 
-  async with aiohttp.ClientSession() as sess:
-    webhook = discord.Webhook.from_url(
-      url=url,
-      session=sess
-    )
+  webhook = discord.Webhook.from_url(
+    url=url,
+    session=get_session()
+  )
+
+  if len(embeds) == 0 and embed is not None:
+    embeds = [embed]
+
+  if len(files) == 0 and file is not None:
+    files = [file]
 
-    if len(embeds) == 0 and embed is not None:
-      embeds = [embed]
+  # attachments made here, the caller's own files are left for it to close
+  created: List[discord.File] = []
 
-    if len(files) == 0 and file is not None:
-      files = [file]
+  # add the response to the file array
+  if response:
+    filename = 'response.txt'
 
-    # add the response to the file array
-    if response:
-      filename = 'response.txt'
-      content = response.text
+    if isinstance(response, requests.Response):
+      # we only want to include the response if it's text-based
+      content_type = response.headers.get('content-type', '')
 
-      if isinstance(response, dict) or hasattr(response, '__dict__'):
-        data = response if isinstance(response, dict) else response.__dict__
+      if 'text' in content_type or 'json' in content_type:
+        response_text = response.text
 
-        filename = 'response.json'
-        content = json.dumps(data, indent=2)
+        # adjust filename if json obj
+        if 'json' in content_type:
+          filename = 'response.json'
+          content_obj = response.json()
+          response_text = json.dumps(content_obj, indent=2)
 
-        files.append(discord.File(
-          fp=io.BytesIO(content.encode('utf-8')),
+        created.append(discord.File(
+          fp=io.BytesIO(response_text.encode('utf-8')),
           filename=filename
         ))
-      elif isinstance(response, requests.Response):
-        # we only want to include the response if it's text-based
-        content_type = response.headers.get('content-type')
-
-        if 'text' in content_type or 'json' in content_type:
-          # adjust filename if json obj
-          if 'json' in content_type:
-            filename = 'response.json'
-            content_obj = response.json()
-            content = json.dumps(content_obj, indent=2)
-
-          files.append(discord.File(
-            fp=io.BytesIO(content.encode('utf-8')),
-            filename=filename
-          ))
-
-
-    # add the exception to the file array
-    if exception:
-      if isinstance(exception, Exception):
-        tb_str = traceback.format_exception(exception)
-        exc_str = '\n'.join(tb_str)
-      else:
-        exc_str = str(exception)
-
-      files.append(discord.File(
-        fp=io.BytesIO(
-          exc_str.encode('utf-8')
-        ),
-        filename='error.txt'
+    elif isinstance(response, dict) or hasattr(response, '__dict__'):
+      data = response if isinstance(response, dict) else response.__dict__
+
+      filename = 'response.json'
+      response_text = json.dumps(data, indent=2, default=str)
+
+      created.append(discord.File(
+        fp=io.BytesIO(response_text.encode('utf-8')),
+        filename=filename
       ))
 
-    try:
-      await webhook.send(
-        content,
-        embeds=embeds,
-        files=files
-      )
-    except Exception as e:
-      print(f'Failed to send webhook message to URL "{url}"', e)
-      traceback.print_exc()
+
+  # add the exception to the file array
+  if exception:
+    if isinstance(exception, Exception):
+      tb_str = traceback.format_exception(exception)
+      exc_str = '\n'.join(tb_str)
+    else:
+      exc_str = str(exception)
+
+    created.append(discord.File(
+      fp=io.BytesIO(
+        exc_str.encode('utf-8')
+      ),
+      filename='error.txt'
+    ))
+
+  try:
+    await webhook.send(
+      content,
+      embeds=embeds,
+      files=files + created
+    )
+  except Exception as e:
+    print(f'Failed to send webhook message to URL "{url}"', e)
+    traceback.print_exc()
+  finally:
+    # release our attachment buffers straight away rather than whenever they're collected
+    for f in created:
+      f.close()